@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""読み取り専用HTTP API
+
+監視プロセスが読み込み済みのデータ(SpectrumCache)から
+ファイルを読み直さずにスペクトラムの切り出しを返す。
+ETagを付けるので、更新がなければ304を返す。
+
+ENDPOINTS:
+    GET /days                     キャッシュしている日付のリスト
+    GET /latest                   最新のスイープ
+    GET /day/{yyyymmdd}           1日分の 時刻 x 周波数
+        ?start=HH:MM&end=HH:MM    時刻の範囲(両端含む)
+        &fmin=22.0&fmax=22.4      周波数の範囲(両端含む)
+    GET /markers/{yyyymmdd}       マーカー周波数の時系列
+
+    ?format=npy をつけるとJSONの代わりにnumpyのnpy形式で値だけを返す。
+    ?column=MAXH をつけるとusecolsの2列目以降の列を返す(既定は1列目)。
+
+USAGE:
+    cache = SpectrumCache()
+    serve(cache, host='127.0.0.1', port=8880)
+    cache.update('20151111', trss, markers=[22.2])
+"""
+import io
+import json
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+from SAtraceWatchdog.tracer import Trace
+
+
+class SpectrumCache:
+    """日付と列名ごとのTrace(index: 周波数, columns: datetime)を保持する
+    列名Noneはusecolsの1列目
+    max_days日分を超えたら古い日付から捨てる。
+    """
+
+    def __init__(self, max_days: int = 2):
+        self.max_days = max_days
+        self._lock = threading.Lock()
+        # (day, column): (version, trss, markers)
+        self._days: OrderedDict = OrderedDict()
+        # 再起動してもETagが重ならないように起動時刻から数える
+        self._version = int(time.time() * 1000)
+
+    def update(self,
+               day: str,
+               trss: Trace,
+               markers: Optional[list] = None,
+               column: Optional[str] = None):
+        """dayのcolumnのデータを入れ替える"""
+        with self._lock:
+            self._version += 1
+            key = (day, column)
+            self._days[key] = (self._version, trss, list(markers or []))
+            self._days.move_to_end(key)
+            while len({d for d, _ in self._days}) > self.max_days:
+                oldest = next(iter(self._days))[0]
+                for key in [k for k in self._days if k[0] == oldest]:
+                    del self._days[key]
+
+    def get(self, day: str, column: Optional[str] = None):
+        """(version, trss, markers)を返す。なければNone"""
+        with self._lock:
+            return self._days.get((day, column))
+
+    def evict(self, day: str):
+        """dayの全列を捨てる"""
+        with self._lock:
+            for key in [k for k in self._days if k[0] == day]:
+                del self._days[key]
+
+    def days(self) -> list[str]:
+        with self._lock:
+            return sorted({d for d, _ in self._days})
+
+
+def _jsonable(values: np.ndarray) -> list:
+    """NaNをnullにしたリスト"""
+    values = np.asarray(values, dtype=float)
+    return np.where(np.isnan(values), None, values).tolist()
+
+
+def _npy(values: np.ndarray) -> bytes:
+    buf = io.BytesIO()
+    np.save(buf, np.asarray(values, dtype=np.float32))
+    return buf.getvalue()
+
+
+def _time_of_day(day: str, hhmm: str) -> pd.Timestamp:
+    return pd.Timestamp(f'{day} {hhmm}')
+
+
+class Handler(BaseHTTPRequestHandler):
+    """GETだけを受け付けるハンドラ"""
+    cache: SpectrumCache = None
+
+    def log_message(self, format, *args):
+        """アクセスログは出力しない"""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        parts = [p for p in url.path.split('/') if p]
+        try:
+            if parts == ['days']:
+                self.send_json({'days': self.cache.days()}, etag=None)
+            elif parts == ['latest']:
+                self.latest(query)
+            elif len(parts) == 2 and parts[0] == 'day':
+                self.day(parts[1], query)
+            elif len(parts) == 2 and parts[0] == 'markers':
+                self.markers(parts[1], query)
+            else:
+                self.send_error(404)
+        except (KeyError, ValueError) as _e:
+            self.send_error(400, type(_e).__name__)
+
+    def not_modified(self, etag: str) -> bool:
+        """If-None-Matchが一致したら304を返してTrue"""
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return True
+        return False
+
+    def send_body(self, body: bytes, content_type: str, etag: Optional[str]):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, obj, etag: Optional[str]):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_body(body, 'application/json; charset=utf-8', etag)
+
+    def lookup(self, day: str, query: dict):
+        """dayのキャッシュとETagを返す。304を返したらNone"""
+        entry = self.cache.get(day, query.get('column'))
+        if entry is None:
+            self.send_error(404, f'no data for {day}')  # ヘッダはlatin-1のみ
+            return None
+        version = entry[0]
+        etag = f'"{day}-{version}-{abs(hash(frozenset(query.items())))}"'
+        if self.not_modified(etag):
+            return None
+        return entry, etag
+
+    def latest(self, query: dict):
+        days = self.cache.days()
+        if not days:
+            self.send_error(404, 'no data')
+            return
+        found = self.lookup(days[-1], query)
+        if found is None:
+            return
+        (_, trss, _), etag = found
+        values = trss.iloc[:, -1].to_numpy()
+        if query.get('format') == 'npy':
+            self.send_body(_npy(values), 'application/octet-stream', etag)
+            return
+        self.send_json(
+            {
+                'time': str(trss.columns[-1]),
+                'unit': trss.index.name,
+                'freqs': trss.index.tolist(),
+                'values': _jsonable(values),
+            },
+            etag=etag)
+
+    def day(self, day: str, query: dict):
+        found = self.lookup(day, query)
+        if found is None:
+            return
+        (_, trss, _), etag = found
+        if 'start' in query or 'end' in query:
+            start = _time_of_day(day, query.get('start', '00:00'))
+            end = _time_of_day(day, query.get('end', '23:59:59'))
+            trss = trss.loc[:, start:end]
+        if 'fmin' in query or 'fmax' in query:
+            fmin = float(query.get('fmin', trss.index.min()))
+            fmax = float(query.get('fmax', trss.index.max()))
+            trss = trss.loc[fmin:fmax]
+        # 時刻 x 周波数
+        values = trss.T.to_numpy()
+        if query.get('format') == 'npy':
+            self.send_body(_npy(values), 'application/octet-stream', etag)
+            return
+        self.send_json(
+            {
+                'times': [str(t) for t in trss.columns],
+                'unit': trss.index.name,
+                'freqs': trss.index.tolist(),
+                'values': _jsonable(values),
+            },
+            etag=etag)
+
+    def markers(self, day: str, query: dict):
+        found = self.lookup(day, query)
+        if found is None:
+            return
+        (_, trss, markers), etag = found
+        trss = Trace(trss)
+        trss.markers = markers
+        # 時刻 x マーカー
+        values = trss.reindex(trss.markers).T.to_numpy()
+        if query.get('format') == 'npy':
+            self.send_body(_npy(values), 'application/octet-stream', etag)
+            return
+        self.send_json(
+            {
+                'times': [str(t) for t in trss.columns],
+                'markers': [float(m) for m in trss.markers],
+                'values': _jsonable(values),
+            },
+            etag=etag)
+
+
+def serve(cache: SpectrumCache, host: str = '127.0.0.1', port: int = 8880):
+    """cacheを返すHTTPサーバーをデーモンスレッドで起動して返す"""
+    handler = type('Handler', (Handler, ), {'cache': cache})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""取得が終わった日のtxtファイルを圧縮する
+
+read_trace(), read_traces()と監視ツールは.txt.gz, .txt.zstをそのまま読めるので、
+過去の日のtxtファイルを圧縮して保存容量と読み込み量を減らす。
+
+* 圧縮は一時ファイルに書き込んでから名前を変え、最終更新時刻を元のファイルに合わせる。
+  元のtxtファイルは圧縮が終わってから削除するので、途中で止めても壊れたファイルは残らない。
+* 今日からdays日以内のファイルは取得中とみなして圧縮しない。
+* zstd形式はzstandardパッケージが必要。
+
+USAGE:
+    # 2日以上前のtxtファイルをgzipで圧縮
+    $ python compress.py --days 2 data/*.txt
+
+    # 4プロセスでzstd形式に、優先度を下げてバックグラウンドで実行
+    $ nohup python compress.py -j 4 --format zst --nice 10 data/*.txt &
+"""
+import os
+import shutil
+import gzip
+import argparse
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Optional
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+from SAtraceWatchdog.tracer import trace_stem
+
+FORMATS = ('gz', 'zst')
+
+
+def compress_file(filename, fmt: str = 'gz', level: Optional[int] = None) -> Path:
+    """filenameを{filename}.{fmt}に圧縮して元のファイルを削除し、
+    圧縮したファイルのパスを返す
+    """
+    src = Path(filename)
+    dst = src.with_name(f'{src.name}.{fmt}')
+    tmp = src.with_name(f'.{dst.name}.tmp')
+    try:
+        with open(src, 'rb') as fin:
+            if fmt == 'gz':
+                with gzip.open(tmp, 'wb', compresslevel=level or 6) as fout:
+                    shutil.copyfileobj(fin, fout)
+            elif fmt == 'zst':
+                import zstandard  # optional dependency
+                cctx = zstandard.ZstdCompressor(level=level or 10)
+                with open(tmp, 'wb') as fout:
+                    cctx.copy_stream(fin, fout)
+            else:
+                raise ValueError(f'{fmt}は{FORMATS}のいずれかを指定してください')
+        stat = src.stat()
+        os.utime(tmp, (stat.st_atime, stat.st_mtime))
+        os.replace(tmp, dst)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    src.unlink()
+    return dst
+
+
+def completed(filename, days: int = 1, today: Optional[date] = None) -> bool:
+    """ファイル名の日付が今日からdays日以上前ならTrue
+
+    >>> completed('20151111_000000.txt', today=date(2015, 11, 12))
+    True
+    >>> completed('20151111_000000.txt', today=date(2015, 11, 11))
+    False
+    """
+    today = today or date.today()
+    day = datetime.strptime(trace_stem(filename)[:8], '%Y%m%d').date()
+    return day <= today - timedelta(days=days)
+
+
+def main():
+    """entry point
+    引数で渡されたtxtファイルのうち、取得が終わった日のファイルを圧縮します。
+    """
+    parser = argparse.ArgumentParser(description='取得が終わった日のtxtファイルを圧縮します')
+    parser.add_argument('files', help='圧縮するtxtファイル。複数指定可能', nargs='*')
+    parser.add_argument('--format',
+                        help='圧縮形式',
+                        choices=FORMATS,
+                        default='gz')
+    parser.add_argument('--level', help='圧縮レベル', type=int, default=None)
+    parser.add_argument('--days',
+                        help='今日からこの日数以内のファイルは圧縮しない',
+                        type=int,
+                        default=1)
+    parser.add_argument('-j',
+                        '--jobs',
+                        help='並列に実行するプロセス数',
+                        type=int,
+                        default=1)
+    parser.add_argument('--nice', help='プロセスの優先度を下げる値', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.nice:
+        os.nice(args.nice)  # 子プロセスにも引き継がれる
+    files = []
+    for f in args.files:
+        if not f.endswith('.txt'):
+            continue
+        try:
+            if completed(f, args.days):
+                files.append(f)
+        except ValueError:  # ファイル名に日付がない
+            continue
+    print(f'compress {len(files)} of {len(args.files)} files')
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {
+            executor.submit(compress_file, f, args.format, args.level): f
+            for f in files
+        }
+        with tqdm(total=len(futures), unit='files') as pbar:
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as _e:
+                    tqdm.write(f'{futures[future]}: {_e}')
+                pbar.update()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""受信時のS/N比しきい値検出
+
+txtファイルを読み込んだ直後に1スイープごとに実行して、
+マーカー周波数のS/N比がしきい値を超えたら通知メッセージを返す。
+
+* S/N比 = 値 - ノイズフロア(1/4 quantile, Trace.noisefloor()と同じ)
+* 一度しきい値を超えたら、threshold - hysteresis を下回るまで再通知しない
+* all_bins=Trueのときは、全周波数についても
+  スイープごとの移動平均で求めたノイズフロアとの差を調べる
+"""
+from typing import Optional
+import numpy as np
+import pandas as pd
+
+
+class Detector:
+    """マーカー周波数ごとの状態を持つS/N比しきい値検出器
+
+    >>> det = Detector(markers=[2.0], threshold=10, hysteresis=3)
+    >>> index = np.arange(5.0)
+    >>> det.update(pd.Series([0, 0, 12, 0, 0.0], index=index), '00:00')
+    ['00:00 マーカー 2.0 S/N比 12.0dB >= 10dB']
+    >>> det.update(pd.Series([0, 0, 11, 0, 0.0], index=index), '00:05')
+    []
+    >>> det.update(pd.Series([0, 0, 5, 0, 0.0], index=index), '00:10')
+    []
+    >>> det.update(pd.Series([0, 0, 13, 0, 0.0], index=index), '00:15')
+    ['00:15 マーカー 2.0 S/N比 13.0dB >= 10dB']
+    """
+
+    def __init__(self,
+                 markers: list[float],
+                 threshold: float = 10,
+                 hysteresis: float = 3,
+                 all_bins: bool = False,
+                 floor_alpha: float = 0.05):
+        """
+        markers: 監視する周波数のリスト
+        threshold: 通知するS/N比[dB]
+        hysteresis: 通知後、threshold - hysteresis を下回るまで再通知しない[dB]
+        all_bins: 全周波数を移動平均のノイズフロアと比較する
+        floor_alpha: 移動平均のノイズフロアの更新係数
+        """
+        self.markers = list(markers)
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.all_bins = all_bins
+        self.floor_alpha = floor_alpha
+        self._index: Optional[np.ndarray] = None
+        self._marker_idx: Optional[np.ndarray] = None
+        self._active = np.zeros(len(self.markers), dtype=bool)
+        self._floor: Optional[np.ndarray] = None
+        self._band_active = False
+
+    def _set_index(self, index: np.ndarray):
+        """周波数軸が変わったらマーカー位置と移動平均を作り直す"""
+        self._index = index
+        self._marker_idx = np.array(
+            [np.argmin(np.abs(index - m)) for m in self.markers], dtype=int)
+        self._floor = None
+
+    def update(self, trs: pd.Series, timestamp) -> list[str]:
+        """1スイープ(index: 周波数)を調べて通知メッセージのリストを返す"""
+        index = trs.index.to_numpy(dtype=float)
+        if self._index is None or not np.array_equal(index, self._index):
+            self._set_index(index)
+        values = trs.to_numpy(dtype=float)
+        messages = []
+
+        # マーカー周波数
+        floor = np.nanquantile(values, 0.25)
+        sn = values[self._marker_idx] - floor
+        fire = ~self._active & (sn >= self.threshold)
+        self._active |= fire
+        self._active &= ~(sn < self.threshold - self.hysteresis)
+        for i in np.flatnonzero(fire):
+            messages.append(f'{timestamp} マーカー {index[self._marker_idx[i]]} '
+                            f'S/N比 {sn[i]:.1f}dB >= {self.threshold}dB')
+
+        # 全周波数
+        if self.all_bins:
+            if self._floor is None:
+                self._floor = values.copy()
+            excess = values - self._floor
+            peak = np.nanargmax(excess) if np.isfinite(excess).any() else None
+            above = peak is not None and excess[peak] >= self.threshold
+            if above and not self._band_active:
+                count = int(np.sum(excess >= self.threshold))
+                messages.append(f'{timestamp} 周波数 {index[peak]} '
+                                f'S/N比 {excess[peak]:.1f}dB >= {self.threshold}dB '
+                                f'(しきい値超え {count}点)')
+            if above:
+                self._band_active = True
+            elif peak is None or excess[peak] < self.threshold - self.hysteresis:
+                self._band_active = False
+            # 信号でノイズフロアが持ち上がらないようにしきい値未満の点だけ更新
+            quiet = excess < self.threshold
+            self._floor[quiet] += self.floor_alpha * excess[quiet]
+        return messages
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
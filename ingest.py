@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""ソケットからSAtraceのデータを受け取る
+
+txtファイルを書き込んで監視ツールが見つけるのを待つ代わりに、
+TCPソケットかUNIXドメインソケットでtxtファイルの中身を直接受け取る。
+受け取ったデータはメモリ上に溜めておき、監視ツールが次のループで取り出す。
+archiveを指定すると、受け取ったデータを別スレッドでtxtファイルに保存する。
+
+PROTOCOL:
+    1つの接続で何回でも送れる。1回分は次の形式
+
+        {ファイル名} {バイト数}\\n
+        {txtファイルの中身(UTF-8)}
+
+    ファイル名は %Y%m%d_%H%M%S.txt 形式(拡張子は省略可)。
+    受け取るたびに `OK {ファイル名}\\n` か `ERR {エラー}\\n` を返す。
+    1行目が読めないか、バイト数がmax_sizeを超えるときはERRを返して接続を切る。
+
+USAGE:
+    # 受信(監視ツールはconfigのingest_addressで起動する)
+    server = IngestServer('127.0.0.1:8881', archive='archive')
+    server.start()
+    for sweep in server.drain():
+        trs = read_trace_text(sweep.text, usecols='AVER')
+
+    # 送信
+    $ python ingest.py 127.0.0.1:8881 20151111_000000.txt ...
+    $ python ingest.py unix:/tmp/satrace.sock 20151111_000000.txt ...
+"""
+import io
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import NamedTuple, Optional
+from SAtraceWatchdog.tracer import is_complete, open_trace, trace_stem
+
+log = logging.getLogger(__name__)
+# 1行目(ファイル名とバイト数)の最大長
+HEADER_SIZE = 1024
+
+
+class Sweep(NamedTuple):
+    """受け取った1スイープ分のデータ"""
+    name: str  # 拡張子なしのファイル名 %Y%m%d_%H%M%S
+    text: str  # txtファイルの中身
+
+
+def parse_address(address: str):
+    """'host:port'か'unix:/path/to.sock'を(ソケットファミリ, アドレス)にする
+
+    >>> parse_address('127.0.0.1:8881')
+    (<AddressFamily.AF_INET: 2>, ('127.0.0.1', 8881))
+    >>> parse_address('unix:/tmp/satrace.sock')
+    (<AddressFamily.AF_UNIX: 1>, '/tmp/satrace.sock')
+    """
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def check_sweep(name: str, text: str) -> Sweep:
+    """ファイル名と中身を確かめてSweepを返す。不正ならValueError"""
+    base = trace_stem(name)
+    datetime.strptime(base, '%Y%m%d_%H%M%S')  # ValueError
+    if not is_complete(io.StringIO(text)):
+        raise ValueError(f'{base}: データが揃っていません')
+    return Sweep(base, text)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """1接続分の受信
+    self.server.ingestに受け取ったSweepを入れる
+    """
+
+    def handle(self):
+        max_size = self.server.ingest.max_size
+        while True:
+            line = self.rfile.readline(HEADER_SIZE)
+            if not line:
+                break
+            try:
+                name, size = line.decode('utf-8').split()
+                size = int(size)
+            except (ValueError, UnicodeDecodeError) as _e:
+                size, reply = None, f'ERR {type(_e).__name__} {_e}\n'
+            else:
+                if not 0 < size <= max_size:
+                    reply = f'ERR ValueError バイト数が不正です {size} (上限{max_size})\n'
+                    size = None
+            if size is None:
+                # 本体の終わりがわからないので接続を切る
+                self.wfile.write(reply.encode('utf-8'))
+                break
+            try:
+                body = self.rfile.read(size)
+                if len(body) < size:
+                    raise ValueError('データが途中で切れました')
+                sweep = check_sweep(name, body.decode('utf-8'))
+                self.server.ingest.put(sweep)
+                reply = f'OK {sweep.name}\n'
+            except (ValueError, UnicodeDecodeError, queue.Full) as _e:
+                reply = f'ERR {type(_e).__name__} {_e}\n'
+            self.wfile.write(reply.encode('utf-8'))
+
+
+class IngestServer:
+    """受け取ったSweepをキューに溜めるソケットサーバー"""
+
+    def __init__(self,
+                 address: str,
+                 archive=None,
+                 maxsize: int = 10000,
+                 max_size: int = 8 * 1024**2):
+        """
+        address: 'host:port'か'unix:/path/to.sock'
+        archive: 受け取ったデータをtxtファイルに保存するディレクトリ。Noneで保存しない
+        maxsize: 取り出されるまで溜めておくSweepの数。超えたらERRを返す
+        max_size: 1回分のバイト数の上限。超えたらERRを返して接続を切る
+        """
+        self.address = address
+        self.max_size = max_size
+        self.archive = None if archive is None else Path(archive)
+        self.queue: queue.Queue = queue.Queue(maxsize)
+        # データが届いたらセットする(監視ループのsleepを起こす)
+        self.arrived = threading.Event()
+        self._archive_queue: queue.Queue = queue.Queue()
+        self._server: Optional[socketserver.BaseServer] = None
+
+    def start(self):
+        """サーバーと保存用のスレッドをデーモンスレッドで起動する"""
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):  # 前回の起動で残ったソケット
+                os.unlink(address)
+            server_class = socketserver.ThreadingUnixStreamServer
+        else:
+            server_class = socketserver.ThreadingTCPServer
+            server_class.allow_reuse_address = True
+        self._server = server_class(address, Handler)
+        self._server.daemon_threads = True
+        self._server.ingest = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        if self.archive is not None:
+            self.archive.mkdir(parents=True, exist_ok=True)
+            threading.Thread(target=self._write_archive, daemon=True).start()
+
+    def stop(self):
+        """サーバーを止め、保存待ちのデータを書き出す"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self.archive is not None:
+            self._archive_queue.put(None)
+            self._archive_queue.join()
+
+    def put(self, sweep: Sweep):
+        """キューに入れる。満杯ならqueue.Full"""
+        self.queue.put_nowait(sweep)
+        if self.archive is not None:
+            self._archive_queue.put(sweep)
+        self.arrived.set()
+
+    def drain(self) -> list[Sweep]:
+        """溜まっているSweepをすべて取り出す"""
+        self.arrived.clear()
+        sweeps = []
+        while True:
+            try:
+                sweeps.append(self.queue.get_nowait())
+            except queue.Empty:
+                return sweeps
+
+    def _write_archive(self):
+        """archiveに{ファイル名}.txtとして保存する
+        書き込み途中のファイルが見えないように一時ファイルから名前を変える
+        """
+        while True:
+            sweep = self._archive_queue.get()
+            try:
+                if sweep is None:
+                    return
+                tmp = self.archive / f'.{sweep.name}.txt.tmp'
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    f.write(sweep.text)
+                os.replace(tmp, self.archive / f'{sweep.name}.txt')
+            except OSError as _e:
+                log.warning(f'{sweep.name}: 保存に失敗しました {_e}')
+            finally:
+                self._archive_queue.task_done()
+
+
+def send(address: str, *files) -> list[str]:
+    """filesの中身をaddressのIngestServerに送り、返事のリストを返す"""
+    family, address = parse_address(address)
+    replies = []
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(address)
+        reader = sock.makefile('rb')
+        for f in files:
+            with open_trace(f) as fin:  # 圧縮ファイルは展開して送る
+                body = fin.read().encode('utf-8')
+            sock.sendall(f'{Path(f).name} {len(body)}\n'.encode('utf-8') + body)
+            replies.append(reader.readline().decode('utf-8').strip())
+    return replies
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='txtファイルをIngestServerに送信します')
+    parser.add_argument('address', help="'host:port' or 'unix:/path/to.sock'")
+    parser.add_argument('files', help='送信するtxtファイル', nargs='+')
+    args = parser.parse_args()
+    for reply in send(args.address, *args.files):
+        print(reply)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""共有ディレクトリのリースファイルによる複数台での処理の分担
+
+同じtxtディレクトリとpngディレクトリを複数のマシン(またはプロセス)で監視するとき、
+処理の単位(1ファイルのスペクトラム、1日のウォーターフォール)ごとに
+リースファイル{unit}.leaseを作って、取得できた1台だけが処理する。
+
+* リースの取得は一時ファイルをos.link()でリースファイルにする。
+  linkは既にファイルがあれば失敗するので、同時に取得しても1台だけが成功する。
+* リースには所有者と有効期限(time()の値)を書く。
+  所有者は有効期限が切れる前にrenew()で延長する。
+* 期限が切れたリース(所有者が落ちた)は他の所有者が引き継げる。
+  期限切れのリースは別名にrenameしてから作り直すので、
+  同時に引き継ごうとしても1台だけが成功する。
+* 有効期限はマシン間で比較するので、時刻を同期(NTP)し、ttlは時刻のずれより十分長くする。
+
+出力ファイルはatomic_path()で一時ファイルに書き込んでから名前を変えるので、
+他のマシンから書き込み途中のファイルは見えない。
+
+USAGE:
+    leases = LeaseManager('png/.leases', ttl=900)
+    if leases.acquire('spectrum_20151111_000000'):
+        with atomic_path('png/20151111_000000.png') as tmp:
+            plt.savefig(tmp)
+        leases.release('spectrum_20151111_000000')
+"""
+import json
+import os
+import socket
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from time import time
+from typing import Optional, Set
+
+
+def default_owner() -> str:
+    """ホスト名とプロセスIDの所有者名"""
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+@contextmanager
+def atomic_path(filename):
+    """filenameと同じディレクトリの一時ファイル名を返し、
+    withを抜けたら一時ファイルをfilenameに置き換える
+    一時ファイル名はドットで始まり、拡張子はfilenameと同じ(savefigが形式を判定する)
+
+    >>> import tempfile
+    >>> d = Path(tempfile.mkdtemp())
+    >>> with atomic_path(d / 'a.txt') as tmp:
+    ...     _ = tmp.write_text('done')
+    ...     (d / 'a.txt').exists(), tmp.name.startswith('.a.')
+    (False, True)
+    >>> (d / 'a.txt').read_text(), len(list(d.iterdir()))
+    ('done', 1)
+    """
+    filename = Path(filename)
+    tmp = filename.with_name(
+        f'.{filename.stem}.{uuid.uuid4().hex[:8]}{filename.suffix}')
+    try:
+        yield tmp
+        os.replace(tmp, filename)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+class LeaseManager:
+    """directoryのリースファイルで処理の単位を排他する
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> a = LeaseManager(d, owner='a', ttl=60)
+    >>> b = LeaseManager(d, owner='b', ttl=60)
+    >>> a.acquire('waterfall_20151111'), b.acquire('waterfall_20151111')
+    (True, False)
+    >>> a.release('waterfall_20151111')
+    >>> b.acquire('waterfall_20151111')
+    True
+    >>> b.ttl = -1  # bが落ちて期限切れ
+    >>> b.renew('waterfall_20151111')
+    True
+    >>> a.expired()
+    ['waterfall_20151111']
+    >>> a.acquire('waterfall_20151111')  # aが引き継ぐ
+    True
+    >>> b.renew_all()  # bが復帰しても取り返さない
+    >>> b.held
+    set()
+    """
+
+    def __init__(self, directory, owner: Optional[str] = None, ttl: float = 900):
+        """
+        directory: リースファイルを置く共有ディレクトリ
+        owner: 所有者名。Noneでホスト名とプロセスID
+        ttl: リースの有効期間(sec)
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.owner = owner or default_owner()
+        self.ttl = ttl
+        # 取得中のリース
+        self.held: Set[str] = set()
+        # 最後にrenew_all()した時刻
+        self.renewed = time()
+
+    def _path(self, unit: str) -> Path:
+        return self.directory / f'{unit}.lease'
+
+    def _content(self) -> str:
+        return json.dumps({
+            'owner': self.owner,
+            'token': uuid.uuid4().hex,
+            'expires': time() + self.ttl,
+        })
+
+    def _tmp(self) -> Path:
+        return self.directory / f'.{uuid.uuid4().hex}.tmp'
+
+    @staticmethod
+    def read(path: Path) -> Optional[dict]:
+        """リースファイルの中身。なければNone"""
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:  # 壊れたファイルは期限切れとして扱う
+            return {'owner': None, 'token': None, 'expires': 0}
+
+    def _create(self, path: Path) -> bool:
+        """リースファイルがなければ作ってTrue、あればFalse"""
+        tmp = self._tmp()
+        tmp.write_text(self._content())
+        try:
+            os.link(tmp, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            tmp.unlink()
+
+    def _break(self, path: Path, lease: dict) -> bool:
+        """期限切れのリースファイルを削除してTrue
+        その間に他の所有者が作り直していたら戻してFalse
+        """
+        stale = self.directory / f'.{path.name}.{uuid.uuid4().hex}.stale'
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:  # 他の所有者が先に削除した
+            return True
+        try:
+            if self.read(stale) != lease:  # 作り直された新しいリースだった
+                try:
+                    os.link(stale, path)
+                except FileExistsError:
+                    pass
+                return False
+            return True
+        finally:
+            stale.unlink(missing_ok=True)
+
+    def acquire(self, unit: str) -> bool:
+        """unitのリースを取得(所有済みなら延長)できたらTrue"""
+        path = self._path(unit)
+        for _ in range(2):
+            if self._create(path):
+                self.held.add(unit)
+                return True
+            lease = self.read(path)
+            if lease is None:  # 直前に解放された
+                continue
+            if lease['owner'] == self.owner:
+                return self.renew(unit)
+            if lease['expires'] > time() or not self._break(path, lease):
+                return False
+        return False
+
+    def renew(self, unit: str) -> bool:
+        """unitのリースの有効期限を延長する
+        他の所有者に引き継がれていたらFalse
+
+        読んでから上書きする間に引き継がれないように、
+        リースファイルを別名にrenameしてから中身を確かめ、新しいリースをlinkで作る。
+        renameかlinkが他の所有者と競合したときは引き継がれたものとしてFalse
+        """
+        path = self._path(unit)
+        lease = self.read(path)
+        if lease is None or lease['owner'] != self.owner:
+            self.held.discard(unit)
+            return False
+        moved = self.directory / f'.{path.name}.{uuid.uuid4().hex}.renew'
+        try:
+            os.rename(path, moved)
+        except FileNotFoundError:  # 読んだ直後に引き継がれた
+            self.held.discard(unit)
+            return False
+        try:
+            if self.read(moved) != lease:  # 引き継がれた新しいリースだった
+                try:
+                    os.link(moved, path)
+                except FileExistsError:
+                    pass
+                self.held.discard(unit)
+                return False
+            if not self._create(path):  # renameしてから作る間に取得された
+                self.held.discard(unit)
+                return False
+        finally:
+            moved.unlink(missing_ok=True)
+        self.held.add(unit)
+        return True
+
+    def renew_all(self):
+        """取得中のリースをすべて延長する(監視ループごとに呼ぶ)"""
+        self.renewed = time()
+        for unit in list(self.held):
+            self.renew(unit)
+
+    def renew_due(self) -> bool:
+        """前回のrenew_all()からttlの1/4経ったらTrue(長い処理の途中で延長する)"""
+        return time() - self.renewed >= self.ttl / 4
+
+    def release(self, unit: str):
+        """unitのリースを解放する"""
+        self.held.discard(unit)
+        path = self._path(unit)
+        lease = self.read(path)
+        if lease is not None and lease['owner'] == self.owner:
+            path.unlink(missing_ok=True)
+
+    def release_all(self):
+        """取得中のリースをすべて解放する(終了時に呼ぶ)"""
+        for unit in list(self.held):
+            self.release(unit)
+
+    def clear(self, unit: str) -> bool:
+        """期限切れのunitのリースを削除する(処理が終わっていて引き継ぐ必要がないとき)
+        削除したか、既になければTrue
+        """
+        path = self._path(unit)
+        lease = self.read(path)
+        if lease is None:
+            return True
+        if lease['expires'] > time():
+            return False
+        return self._break(path, lease)
+
+    def expired(self) -> list[str]:
+        """期限切れのリース(所有者が落ちた処理の単位)"""
+        now = time()
+        units = []
+        for path in sorted(self.directory.glob('*.lease')):
+            lease = self.read(path)
+            if lease is not None and lease['expires'] <= now:
+                units.append(path.stem)
+        return units
+
+
+def _contend(directory, owner: str, unit: str, rounds: int):
+    """race()の1プロセス分
+    リースを取得できたらholderディレクトリを作り、延長してから消して解放する。
+    holderが既にあれば(2台が同時にリースを持っていれば)違反として数え、
+    違反の数を終了コードにする
+    """
+    leases = LeaseManager(directory, owner=owner, ttl=60)
+    holder = Path(directory) / 'holder'
+    violations = 0
+    for _ in range(rounds):
+        if not leases.acquire(unit):
+            continue
+        try:
+            holder.mkdir()
+        except FileExistsError:
+            violations += 1
+            leases.release(unit)
+            continue
+        leases.renew(unit)
+        holder.rmdir()
+        leases.release(unit)
+    os._exit(min(violations, 255))
+
+
+def race(directory, processes: int = 8, rounds: int = 200,
+         unit: str = 'sweeps') -> int:
+    """processes個のプロセスで同じunitのリースを取り合い、
+    2つ以上のプロセスが同時にリースを持った回数を返す(fork可能なOSのみ)
+
+    >>> import tempfile
+    >>> race(tempfile.mkdtemp())
+    0
+    """
+    import multiprocessing
+    context = multiprocessing.get_context('fork')
+    workers = [
+        context.Process(target=_contend,
+                        args=(directory, f'node{i}', unit, rounds))
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(worker.exitcode for worker in workers)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
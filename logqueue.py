@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""ノンブロッキングなログ出力
+
+ログの書き込み(コンソール、ファイル)を別スレッドのQueueListenerで行い、
+監視ループは上限付きのキューに積むだけにする。
+ログの保存先が遅い(ネットワークマウント)ときでも監視ループは止まらない。
+キューが満杯のときはログを捨てて、捨てた件数をdroppedに数える。
+
+USAGE:
+    handler, listener = start_logging([console_handler, file_handler])
+    ...
+    listener.stop()  # 終了時にキューに残ったログを書き出す
+"""
+import json
+import logging
+import queue
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+# LogRecordが標準で持つ属性。これ以外はextraで渡された値
+_RESERVED = set(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+
+class DropQueueHandler(QueueHandler):
+    """キューが満杯のときは待たずにログを捨てるQueueHandler"""
+
+    def __init__(self, maxsize: int = 10000):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコード1行のJSON形式
+    extraで渡された値(file, elapsed, ...)もキーとして出力する
+
+    >>> record = logging.makeLogRecord({'msg': 'read', 'levelname': 'DEBUG',
+    ...                                 'module': 'main', 'created': 0,
+    ...                                 'file': 'a.txt', 'elapsed': 0.5})
+    >>> line = json.loads(JsonFormatter().format(record))
+    >>> line['message'], line['file'], line['elapsed']
+    ('read', 'a.txt', 0.5)
+    """
+
+    def format(self, record) -> str:
+        line = {
+            'time': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'module': record.module,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED:
+                line[key] = value
+        if record.exc_info:
+            line['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+
+def start_logging(handlers: list[logging.Handler],
+                  maxsize: int = 10000,
+                  level=logging.INFO) -> tuple[DropQueueHandler, QueueListener]:
+    """ルートロガーにDropQueueHandlerを追加し、
+    handlersへ書き込むQueueListenerを起動して両方を返す
+    各handlerのレベルはQueueListener側で判定する
+    """
+    root_logger = logging.getLogger('')
+    root_logger.setLevel(level)
+    queue_handler = DropQueueHandler(maxsize)
+    root_logger.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue,
+                             *handlers,
+                             respect_handler_level=True)
+    listener.start()
+    return queue_handler, listener
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -4,23 +4,34 @@ txtファイルとpngファイルの差分をチェックして、グラフ化
 """
 import sys
 import os
-from typing import Dict, List, Any, Optional
+import io
+import json
+from typing import Dict, List, Set, Any, Optional
 import argparse
-from time import sleep
-from datetime import datetime
+from time import sleep, time
+from datetime import datetime, timedelta
 import glob
 import logging
 from logging import handlers
 from functools import partial
 from pathlib import Path
 from collections import defaultdict
-import numpy as np
-import matplotlib.pyplot as plt
-from tqdm import tqdm
+from types import SimpleNamespace
+import pandas as pd
 from SAtraceWatchdog import tracer
-from SAtraceWatchdog.oneplot import plot_onefile
+from SAtraceWatchdog.oneplot import plot_onefile, plot_options
 from SAtraceWatchdog.slack import Slack
 from SAtraceWatchdog import report
+from SAtraceWatchdog import rollup
+from SAtraceWatchdog import api
+from SAtraceWatchdog import tiles
+from SAtraceWatchdog import logqueue
+from SAtraceWatchdog.detector import Detector
+from SAtraceWatchdog.scheduler import ArrivalScheduler
+from SAtraceWatchdog.ingest import IngestServer
+from SAtraceWatchdog.lease import LeaseManager, atomic_path
+from SAtraceWatchdog.memory import MemoryGovernor
+from SAtraceWatchdog.renderer import Renderer, plot_heatmap, savefig
 
 VERSION = 'v2.0.0'
 DAY_SECOND = 60 * 60 * 24
@@ -46,8 +57,35 @@ class Watch:
     config = None  # Watch.loop() の毎回のループで読み込み
     last_config: Optional[Dict[str, Any]] = None
     last_files: Dict[str, List] = defaultdict(lambda: [])
+    # ウォーターフォールの更新待ちの日付
+    pending_days: Set[str] = set()
+    # S/N比しきい値検出済みのファイル名
+    detected: Optional[Set[str]] = None
+    # freq_rangeがスイープの周波数範囲と重なるか(設定の読み込み後に1回だけ確認)
+    freq_range_ok: Optional[bool] = None
+    # pyarrowがインストールされているか(arrow_exportが有効になったときに確認)
+    arrow_available: Optional[bool] = None
+    # Arrowファイルへ書き出し済みのファイル名(日付ごと)
+    arrow_exported: Dict[str, set] = {}
+    # マーカー統計を書き出し済みのファイル名(日付ごと)
+    marker_recorded: Dict[str, set] = {}
+    # 起動前からあるtxtファイルのうち最新のファイル名
+    # これより古いファイルのArrow出力とマーカー統計は後回しにする
+    sweep_mark: Optional[str] = None
+    # txtファイル名(拡張子なし)とパス(.txt, .txt.gz, .txt.zst)
+    sources: Dict[str, str] = {}
+    # ソケットで受け取ったtxtファイルの中身(スペクトラムを描画するまで保持)
+    streamed: Dict[str, str] = {}
+    # ソケットで受け取ったスイープ(日付ごと、ウォーターフォールの最終処理まで保持)
+    stream_traces: Dict[str, Dict[str, pd.DataFrame]] = defaultdict(dict)
+    # txtファイル名ごとの(パス, サイズ, 最終更新時刻), 最初に見た時刻, 揃っているか
+    file_states: Dict[str, tuple] = {}
+    # 到着を確認済みのtxtファイル名
+    arrived: Optional[Set[str]] = None
     # アップデート記録保持
-    no_update_count = 0
+    # 最後に更新があった時刻(time()の値)
+    no_update_since: Optional[float] = None
+    # transfer_rateの何倍の時間更新がなければ警告するか
     no_update_threshold = 1
 
     def __init__(self, args):
@@ -62,9 +100,39 @@ class Watch:
             print(f'[DEBUG] LOG DIR: {self.logdirectory}')
             print(f'[DEBUG] STATS DIR: {self.statsdirectory}')
         self.stats_file = self.statsdirectory / 'watchdog_SN.xlsx'
+        self.rollupdirectory = Watch.directory_check(self.statsdirectory /
+                                                     'rollup')
+        self.arrowdirectory = Watch.directory_check(self.statsdirectory /
+                                                    'spectra')
+        self.markerdirectory = Watch.directory_check(self.statsdirectory /
+                                                     'markers')
         # loggerの設定
         self.set_logger()
         self.log = logging.getLogger(__name__)
+        # 描画用ワーカープロセス
+        self.renderer = Renderer()
+        # HTTP APIで返す読み込み済みデータ(main()でapi_portを指定したときだけ作る)
+        self.cache: Optional[api.SpectrumCache] = None
+        # S/N比しきい値検出器
+        self.detector: Optional[Detector] = None
+        self.detector_config = None
+        # 次のポーリングまでの時間を決める
+        self.scheduler: Optional[ArrivalScheduler] = None
+        # loop_budget秒で終わらなかった処理が残っているか
+        self.backlog_left = False
+        # ソケットからの受信(main()でingest_addressを指定したときだけ起動)
+        self.ingest: Optional[IngestServer] = None
+        # 複数台での分担(main()でlease_ttlを指定したときだけ使う)
+        self.leases: Optional[LeaseManager] = None
+        # 日付ごとの状態を捨ててメモリ使用量を一定に保つ
+        self.memory = MemoryGovernor(trace=getattr(
+            tracer.json_load_encode_with_bom(CONFIGFILE), 'memory_trace', False))
+        for state in (Watch.last_files, Watch.pending_days,
+                      Watch.arrow_exported, Watch.marker_recorded,
+                      Watch.stream_traces):
+            self.memory.register(state)
+        self.memory.register(Watch.file_states, prefix=True)
+        self.memory.register_evictor(Watch.forget_detected)
 
     @staticmethod
     def directory_check(directory):
@@ -85,11 +153,11 @@ class Watch:
     def set_logger(self):
         """コンソール用ロガーハンドラと
         ファイル用ロガーハンドラを作成し、
-        ルートロガーに追加する
+        ルートロガーのキューから書き込むQueueListenerに渡す
+        log_jsonがTrueのときは、1ファイルごとの処理時間を含む
+        JSON形式のログファイルも作成する
         """
-        # ルートロガーの作成
-        root_logger = logging.getLogger('')
-        root_logger.setLevel(logging.INFO)
+        config = tracer.json_load_encode_with_bom(CONFIGFILE)
 
         # フォーマッターの作成
         formatter = logging.Formatter(
@@ -100,9 +168,6 @@ class Watch:
         console_handler.setLevel(logging.INFO)
         console_handler.setFormatter(formatter)
 
-        # コンソール用ハンドラをルートロガーに追加
-        root_logger.addHandler(console_handler)
-
         # ファイル用ハンドラの作成
         timestamp = datetime.now().strftime('%y%m%d_%H%M%S')
         file_handler = handlers.RotatingFileHandler(
@@ -112,20 +177,46 @@ class Watch:
             backupCount=3)
         file_handler.setLevel(logging.INFO)
         file_handler.setFormatter(formatter)
+        log_handlers = [console_handler, file_handler]
+
+        # 処理時間はDEBUGレベルで出力し、JSON形式のログファイルにだけ書く
+        self.timing = logging.getLogger(f'{__name__}.timing')
+        if getattr(config, 'log_json', False):
+            json_handler = handlers.RotatingFileHandler(
+                filename=f'{self.logdirectory}/watchdog_{timestamp}.jsonl',
+                maxBytes=1e7,
+                encoding='utf-8',
+                backupCount=3)
+            json_handler.setLevel(logging.DEBUG)
+            json_handler.setFormatter(logqueue.JsonFormatter())
+            log_handlers.append(json_handler)
+            self.timing.setLevel(logging.DEBUG)
 
-        # ファイル用ハンドラをルートロガーに追加
-        root_logger.addHandler(file_handler)
+        # 書き込みは別スレッドで行い、監視ループはキューに積むだけにする
+        self.log_handler, self.log_listener = logqueue.start_logging(
+            log_handlers, maxsize=getattr(config, 'log_queue_size', 10000))
+        self.log_dropped = 0
+
+    def check_log_dropped(self):
+        """キューが満杯で捨てたログがあれば件数を警告する"""
+        dropped = self.log_handler.dropped - self.log_dropped
+        if dropped > 0:
+            self.log_dropped += dropped
+            self.log.warning(f'ログの書き込みが追いつかず{dropped}件のログを破棄しました')
 
     def filename_resolver(self,
                           yyyymmdd: str,
                           remove_flag: bool,
-                          ext="png") -> Path:
+                          ext="png",
+                          suffix: str = '') -> Path:
         """Decide waterfall filenamene
         return:
             waterfall_yymmdd_update.png
                 or
             waterfall_yymmdd.png
 
+        suffixはyyyymmddの後ろにつく(usecolsの2列目以降 ex: _MAXH)
+
         ファイル数が一日分=288ファイルあったら
             waterfall_{yyyymmdd}_update.pngを削除して、
             waterfall_{yyyymmdd}.pngを返す
@@ -136,12 +227,13 @@ class Watch:
             png, eps, jpg, pdf,...
             see [matplotlib.pyplot.savefig](https://matplotlib.org/stable/api/_as_gen/matplotlib.pyplot.savefig.html)
         """
-        filename = Path(f'{self.directory}/waterfall_{yyyymmdd}_update.{ext}')
+        filename = Path(
+            f'{self.directory}/waterfall_{yyyymmdd}{suffix}_update.{ext}')
         if remove_flag:  # ファイル数が一日分=288ファイルあったら
             # waterfall_{yyyymmdd}_update.pngを削除して、
             filename.unlink(missing_ok=True)  # ignore FileNotFoundError
             # waterfall_{yyyymmdd}.pngというファイル名を返す
-            filename = Path(f"{self.directory}/waterfall_{yyyymmdd}.{ext}")
+            filename = Path(f"{self.directory}/waterfall_{yyyymmdd}{suffix}.{ext}")
         return filename
 
     def loop(self):
@@ -153,13 +245,35 @@ class Watch:
         if not Watch.config == Watch.last_config:
             Watch.last_config = Watch.config
             Slack().log(self.log.info, f'設定が更新されました {Watch.config}')
+            self.check_arrow()
+            Watch.freq_range_ok = None
+        self.check_freq_range()
+        self.renderer.max_jobs = getattr(Watch.config, 'render_max_jobs', 100)
+        self.renderer.max_rss = getattr(Watch.config, 'render_max_rss', 1024)
+        self.renderer.timeout = getattr(Watch.config, 'render_timeout', 300)
+        self.check_log_dropped()
+        self.renew_leases()
+
+        # ソケットで受け取ったデータ
+        streamed = self.drain_ingest() if self.ingest is not None else set()
 
         # ファイル名差分確認
         pattern = Watch.config.glob
         out = self.directory
-        txts = {Path(i).stem for i in glob.iglob(f'{pattern}.txt')}
+        # 圧縮されたtxtファイルも同じファイル名として扱う
+        Watch.sources = tracer.find_traces(pattern)
+        if Watch.sources:
+            self.check_freq_range(Watch.sources[max(Watch.sources)])
         pngs = {Path(i).stem for i in glob.iglob(f'{out}/{pattern}.png')}
-        update_files = txts - pngs
+        # 描画済みの受信データは捨てる
+        for base in set(Watch.streamed) & pngs:
+            del Watch.streamed[base]
+        txts = set(Watch.sources) | set(Watch.streamed)
+        # 書き込み途中のファイルは次のループまで待つ
+        update_files = {
+            f
+            for f in txts - pngs if self.is_ready(self.source(f))
+        }
         sorted_files = sorted(list(update_files))
 
         # Count report
@@ -169,32 +283,243 @@ class Watch:
         if self.debug:
             Slack().log(print, f'[DEBUG] FILE COUNTS {_counts}')
 
+        # 届いたファイルの到着時刻を学習し、更新がしばらくないときは警告
+        arrived = self.observe_arrivals(set(Watch.sources))
+        self.check_update(arrived | streamed)
+
         # ---
-        # One file plot
+        # Columnar export, S/N alert, Marker stats
         # ---
-        # txtファイルだけあってpngがないファイルに対して実行
-        if Watch.config.save_spectrum:
-            # filename format must be [ %Y%m%d_%H%M%S.txt ]
-            self.save_spectrum_plot(sorted_files)
+        # 描画より先に、新しく届いたファイルを1回だけ読み込んで
+        # Arrowファイルへの追記、S/N比の通知、マーカー統計の追記を行う
+        # 起動前からあるファイルはloop_budgetの範囲で後から処理する
+        if Watch.sweep_mark is None:
+            Watch.sweep_mark = max(sorted(txts)[:-1], default='')
+        history = sorted((b for b in txts if b <= Watch.sweep_mark),
+                         reverse=True)
+        self.process_sweeps(txts,
+                            sorted(b for b in txts if b > Watch.sweep_mark))
 
         # ---
-        # Daily plot
+        # Priority schedule
         # ---
+        # 1. 最新のファイルのスペクトラム
+        # 2. 最新のファイルの日のウォーターフォール
+        # 3. 起動前からあるファイルのArrow出力、マーカー統計(新しい順)
+        # 4. 残りのファイルのスペクトラム(新しい順)
+        # 5. 残りの日のウォーターフォール(新しい順)
+        # 1, 2は必ず実行し、3, 4, 5はloop_budget秒を超えたら次のループに回す
+        budget = getattr(Watch.config, 'loop_budget', None)
+        deadline = time() + budget if budget else float('inf')
+        Watch.pending_days |= {_[:8] for _ in sorted_files}
+        live, backlog = sorted_files[-1:], sorted_files[-2::-1]
+        days = sorted(Watch.pending_days, reverse=True)
+        # txtファイルだけあってpngがないファイルに対して実行
+        # filename format must be [ %Y%m%d_%H%M%S.txt ]
+        if Watch.config.save_spectrum:
+            self.save_spectrum_plot(live)
+        if Watch.config.save_heatmap:
+            self.save_heatmap_plot(days[:1])
+        # loop_budget秒で終わらなかったら、sleep()は到着予定時刻まで待たずに次のループへ
+        self.backlog_left = self.process_sweeps(txts, history, deadline)
+        if Watch.config.save_spectrum:
+            self.backlog_left |= self.save_spectrum_plot(backlog, deadline)
         if Watch.config.save_heatmap:
-            self.save_heatmap_plot(sorted_files)
+            self.backlog_left |= self.save_heatmap_plot(days[1:], deadline)
+        if not Watch.config.save_spectrum:
+            Watch.streamed.clear()
+        self.govern_memory()
+        if self.debug:
+            Slack().log(print,
+                        f'[DEBUG] PENDING DAYS {sorted(Watch.pending_days)}')
+
+    def govern_memory(self):
+        """最終処理が終わった日の状態を捨て、
+        memory_report_interval秒ごとにメモリ使用量をログに出力する
+        """
+        self.memory.budget = getattr(Watch.config, 'memory_budget', None)
+        self.memory.keep_days = getattr(Watch.config, 'memory_keep_days', 2)
+        self.memory.report_interval = getattr(Watch.config,
+                                              'memory_report_interval', 3600)
+        evicted = self.memory.collect()
+        if self.debug and evicted:
+            Slack().log(print, f'[DEBUG] EVICTED DAYS {evicted}')
+        if not self.memory.due():
+            return
+        usage = self.memory.report()
+        usage['renderer_rss'] = round(self.renderer.rss, 1)
+        self.timing.debug('memory', extra=usage)
+        if self.memory.over_budget():
+            Slack().log(self.log.warning,
+                        f'メモリ使用量が上限{self.memory.budget}MBを超えています {usage}')
+        else:
+            self.log.info(f'メモリ使用量 {usage}')
+
+    def check_arrow(self):
+        """arrow_exportが有効なときにpyarrowを1回だけインポートしてみて、
+        インストールされていなければArrowファイル出力を無効にして警告する
+        """
+        if not getattr(Watch.config, 'arrow_export', False):
+            return
+        if Watch.arrow_available is None:
+            Watch.arrow_available = tracer.has_arrow()
+        if not Watch.arrow_available:
+            Slack().log(self.log.warning,
+                        'pyarrowがインストールされていないのでArrowファイル出力を無効にします')
+
+    def check_freq_range(self, data=None):
+        """freq_rangeがdata(txtファイル)のヘッダの周波数範囲と重なるかを
+        設定の読み込み後に1回だけ確かめる
+        重ならなければ設定エラーを1回だけ出して、freq_rangeを指定しないで全範囲を読み込む
+        dataがNoneのときは確かめた結果を今回読み込んだ設定に当てはめるだけ
+        """
+        freq_range = getattr(Watch.config, 'freq_range', None)
+        if freq_range is None:
+            return
+        if Watch.freq_range_ok is None:
+            if data is None:
+                return
+            try:
+                index = tracer.trace_freq_index(data)
+            except Exception:  # 読めるファイルが届いてから確かめる
+                return
+            low, high = freq_range
+            Watch.freq_range_ok = low <= high and low <= index[-1] \
+                and high >= index[0]
+            if not Watch.freq_range_ok:
+                Slack().log(
+                    self.log.error, f'設定エラー: freq_range {list(freq_range)} が'
+                    f'スイープの周波数範囲 [{index[0]}, {index[-1]}] と重なりません。'
+                    '全範囲を読み込みます')
+        if not Watch.freq_range_ok:
+            Watch.config = SimpleNamespace(**{
+                **vars(Watch.config), 'freq_range': None
+            })
+
+    @staticmethod
+    def forget_detected(day: str):
+        """S/N比しきい値検出済みのファイル名からdayのファイルを捨てる"""
+        if Watch.detected is not None:
+            Watch.detected -= {b for b in Watch.detected if b.startswith(day)}
+
+    @staticmethod
+    def usecols() -> List[str]:
+        """config.usecolsのリスト(文字列なら1列だけ)"""
+        usecols = Watch.config.usecols
+        return [usecols] if isinstance(usecols, str) else list(usecols)
+
+    def source(self, base: str):
+        """baseのtxtファイルのパス
+        ソケットで受け取ったデータなら中身のio.StringIO
+        """
+        if base in Watch.streamed:
+            return io.StringIO(Watch.streamed[base])
+        return Watch.sources[base]
+
+    def drain_ingest(self) -> Set[str]:
+        """ソケットで受け取ったデータを取り出し、受け取ったファイル名を返す
+        中身はスペクトラムの描画まで、読み込んだスイープは
+        ウォーターフォールの最終処理まで保持する
+        """
+        names = set()
+        for sweep in self.ingest.drain():
+            self.check_freq_range(io.StringIO(sweep.text))
+            try:
+                trs = tracer.read_trace_text(sweep.text,
+                                             usecols=Watch.usecols(),
+                                             freq_range=getattr(
+                                                 Watch.config, 'freq_range',
+                                                 None))
+            except Exception as _e:
+                Slack().log(self.log.warning,
+                            f'{sweep.name}: 読み込みに失敗しました {_e}')
+                continue
+            names.add(sweep.name)
+            Watch.streamed[sweep.name] = sweep.text
+            Watch.stream_traces[sweep.name[:8]][sweep.name] = trs
+        return names
+
+    @staticmethod
+    def is_ready(filename: str) -> bool:
+        """転送中のファイルでなければTrue
+        ヘッダ、データ、フッタが揃っているか、
+        サイズと最終更新時刻がループをまたいでready_quiet秒変わっていなければ読み込んでよい。
+        最終更新時刻を転送元から引き継ぐコピー(cp -p, rsync -t)では
+        書き込み途中でも最終更新時刻が古いので、経過時間だけでは判断しない。
+        """
+        if hasattr(filename, 'read'):  # ソケットで受け取ったデータ
+            return True
+        quiet = getattr(Watch.config, 'ready_quiet', 10)
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return False
+        key = (str(filename), stat.st_size, stat.st_mtime)
+        base = tracer.trace_stem(filename)
+        state = Watch.file_states.get(base)
+        if state is None or state[0] != key:
+            # 変わったときだけ中身を調べる
+            state = (key, time(), tracer.is_complete(filename))
+            Watch.file_states[base] = state
+        _, since, complete = state
+        return complete or time() - since >= quiet
+
+    @staticmethod
+    def arrival_rate() -> float:
+        """txtファイルが届く間隔(sec)
+        config.arrival_rate(replay.pyで倍速再生するとき)、なければtransfer_rate
+        """
+        return getattr(Watch.config, 'arrival_rate', None) \
+            or Watch.config.transfer_rate
+
+    def observe_arrivals(self, txts: Set[str]) -> Set[str]:
+        """前回のループから新しく届いたtxtファイルを返し、
+        到着時刻(mtime)をschedulerに学習させる
+        """
+        rate = Watch.arrival_rate()
+        if self.scheduler is None or self.scheduler.rate != rate:
+            self.scheduler = ArrivalScheduler(
+                rate,
+                poll_min=getattr(Watch.config, 'poll_min', 1),
+                window_min=getattr(Watch.config, 'poll_window', 5))
+        if Watch.arrived is None:
+            Watch.arrived = set()
+        arrived = txts - Watch.arrived
+        # 消えたファイルの分まで溜め込まないように今あるファイルだけ覚える
+        Watch.arrived = set(txts)
+        mtimes = []
+        # 起動時は最新のファイルだけで学習する
+        for base in sorted(arrived)[-self.scheduler.arrivals.maxlen:]:
+            try:
+                mtimes.append(os.stat(Watch.sources[base]).st_mtime)
+            except FileNotFoundError:
+                continue
+        self.scheduler.observe(mtimes)
+        return arrived
 
     def sleep(self):
-        """Interval for next loop"""
+        """Interval for next loop
+        次のファイルの到着予定時刻の前後は短い間隔で、
+        それ以外は到着予定時刻の少し前まで待つ。
+        学習前と到着が遅れているときはcheck_rate秒待つ。
+        loop_budget秒で終わらなかった処理が残っているときはpoll_min秒だけ待つ。
+        """
+        delay = Watch.config.check_rate
+        if self.scheduler is not None:
+            delay = self.scheduler.next_delay(time(), fallback=delay)
+        if self.backlog_left:
+            delay = min(delay, getattr(Watch.config, 'poll_min', 1))
         if self.debug:
-            Slack().log(print,
-                        f'[DEBUG] sleeping... {Watch.config.check_rate}')
-        # remove progress bar after all
-        for _ in tqdm(range(Watch.config.check_rate), leave=False):
-            sleep(1)
+            Slack().log(print, f'[DEBUG] sleeping... {delay:.1f}')
+        if self.ingest is not None:
+            # ソケットでデータを受け取ったらすぐに次のループへ
+            self.ingest.arrived.wait(delay)
+        else:
+            sleep(delay)
 
     def no_update_warning(self) -> str:
         """更新がしばらくないときにWarning上げるメッセージを作成する"""
-        no_uptime = Watch.no_update_count * Watch.config.transfer_rate
+        no_uptime = int(time() - Watch.no_update_since)
         if no_uptime < 60:
             message = f'最後の更新から{no_uptime}秒'
         elif no_uptime < 3600:
@@ -208,10 +533,17 @@ class Watch:
         """status=0でWatch.loop()を正常終了する。
         status=1でWatch.loop()を異常終了する。
         """
+        self.renderer.stop()
+        if self.ingest is not None:
+            self.ingest.stop()
+        if self.leases is not None:
+            self.leases.release_all()
         if status == 0:
             Slack().log(self.log.info, message=err)
         else:
             Slack().log(self.log.critical, message=err)
+        # キューに残ったログを書き出してから終了する
+        self.log_listener.stop()
         sys.exit(status)
 
     def error(self, err):
@@ -219,35 +551,300 @@ class Watch:
         trace_error = partial(self.log.error, exc_info=True)
         Slack().log(trace_error, err)
 
-    def save_spectrum_plot(self, files: List[str]):
+    def check_update(self, update_files: Set[str]):
+        """更新がしばらくないときにWarningを上げる
+        最後の更新からarrival_rate * no_update_threshold 秒経ったら警告し、
+        次の警告までの時間を2倍にする
+        """
+        if update_files or Watch.no_update_since is None:
+            # Reset count
+            Watch.no_update_since = time()
+            if update_files:
+                Watch.no_update_threshold = 2
+            return
+        # update_filesが空で、更新がないとき
+        elapsed = time() - Watch.no_update_since
+        if elapsed > Watch.no_update_threshold * Watch.arrival_rate():
+            msg = self.no_update_warning()
+            Slack().mention(self.log.warning, msg)
+            Watch.no_update_threshold *= 2
+
+    def get_detector(self) -> Detector:
+        """configのS/N比しきい値検出器
+        configが変わったら作り直す
+        """
+        _config = (
+            tuple(Watch.config.markers),
+            Watch.config.alert_threshold,
+            getattr(Watch.config, 'alert_hysteresis', 3),
+            getattr(Watch.config, 'alert_all_bins', False),
+            getattr(Watch.config, 'alert_floor_alpha', 0.05),
+        )
+        if self.detector is None or self.detector_config != _config:
+            self.detector = Detector(*_config)
+            self.detector_config = _config
+        return self.detector
+
+    def renew_leases(self):
+        """取得中のリースを延長し、期限切れのリース(落ちたマシンの処理)を引き継ぐ"""
+        if self.leases is None:
+            return
+        self.leases.renew_all()
+        for unit in self.leases.expired():
+            # 出力が揃っている(描画後、解放前に落ちた)ときはリースを消すだけ
+            if unit.startswith('spectrum_'):
+                done = self.directory / f'{unit[len("spectrum_"):]}.png'
+            elif unit.startswith('waterfall_'):
+                done = self.directory / f'{unit}.{Watch.config.file_format}'
+            else:
+                continue  # sweepsはprocess_sweeps()で引き継ぐ
+            if done.exists():
+                self.leases.clear(unit)
+                continue
+            # スペクトラムはpngがないので次の差分確認で引き継ぐ
+            if unit.startswith('waterfall_'):
+                day = unit[len('waterfall_'):]
+                Slack().log(self.log.warning, f'{unit}: 期限切れのリースを引き継ぎます')
+                Watch.last_files.pop(day, None)
+                Watch.pending_days.add(day)
+
+    def keep_leases(self):
+        """長い処理の途中で取得中のリースを延長する(ttlの1/4ごと)
+        期限が切れて他のマシンに引き継がれたリースはheldから外れる
+        """
+        if self.leases is not None and self.leases.renew_due():
+            self.leases.renew_all()
+
+    def claim(self, unit: str) -> bool:
+        """unitのリースを取得できたらTrue(分担しないときは常にTrue)"""
+        return self.leases is None or self.leases.acquire(unit)
+
+    def release(self, unit: str):
+        """unitのリースを解放する"""
+        if self.leases is not None:
+            self.leases.release(unit)
+
+    def process_sweeps(self,
+                       txts: Set[str],
+                       files: List[str],
+                       deadline=float('inf')) -> bool:
+        """filesのうちまだ処理していないtxtファイルを1回だけ読み込んで
+        * arrow_export: 日ごとのArrowファイル spectra_{yyyymmdd}.arrows に追記する
+        * alert_threshold: マーカー周波数のS/N比を調べ、しきい値を超えたらslackに通知する
+        * marker_stats: マーカーの統計値を markers/markers_{yyyymmdd}.csv に追記する
+        複数台で分担するときはsweepsのリースを持つ1台だけが行う
+        txtsは起動時にS/N比を調べないファイルを決めるための全txtファイル名
+        deadline(time()の値)を過ぎたら残りは次のループに回してTrueを返す
+        """
+        if not files:
+            return False
+        if self.leases is not None:
+            leader = 'sweeps' in self.leases.held
+            if not self.leases.acquire('sweeps'):
+                return False
+            if not leader:
+                # 引き継いだときは書き出し済みのファイル名をファイルから読み直し、
+                # 起動時と同じく最新のファイルだけS/N比を調べる
+                Watch.arrow_exported.clear()
+                Watch.marker_recorded.clear()
+                Watch.detected = None
+        arrow = getattr(Watch.config, 'arrow_export',
+                        False) and bool(Watch.arrow_available)
+        alert = getattr(Watch.config, 'alert_threshold', None) is not None
+        stats = getattr(Watch.config, 'marker_stats', False)
+        if alert and Watch.detected is None:
+            # 起動前からあるファイルは最新のものだけ調べる
+            Watch.detected = set(sorted(txts)[:-1])
+        column = Watch.usecols()[0]
+        freq_range = getattr(Watch.config, 'freq_range', None)
+        # マーカー統計を追記した日(最終処理が終わっていればレポートを作り直す)
+        appended: Set[str] = set()
+        for base in files:
+            if time() > deadline:
+                self.rebuild_sn_reports(appended - {base[:8]})
+                return True
+            self.keep_leases()
+            if self.leases is not None and 'sweeps' not in self.leases.held:
+                return False  # 他のマシンに引き継がれた
+            day = base[:8]
+            # 最終処理が終わって状態を捨てた日はS/N比を通知済みとして扱う
+            evicted = day in self.memory.evicted
+            tasks = {
+                'arrow': arrow and self.unexported(
+                    base, Watch.arrow_exported, day,
+                    self.arrowdirectory / f'spectra_{day}.arrows',
+                    tracer.arrow_timestamps, tracer.repair_arrow),
+                'alert': alert and not evicted and base not in Watch.detected,
+                'stats': stats and self.unexported(
+                    base, Watch.marker_recorded, day,
+                    report.stats_filename(self.markerdirectory, day),
+                    report.stats_timestamps),
+            }
+            if not any(tasks.values()) or not self.is_ready(self.source(base)):
+                continue
+            self.memory.touch(day)
+            if evicted:
+                # 捨てた日の残り(起動前からあるファイル)を処理したら、また捨ててよい
+                if alert:
+                    Watch.detected |= {b for b in txts if b.startswith(day)}
+                self.memory.finalize(day)
+            # 読み込みや書き出しに失敗したファイルも再試行しない
+            if tasks['arrow']:
+                Watch.arrow_exported[day].add(base)
+            if alert:
+                Watch.detected.add(base)
+            if tasks['stats']:
+                Watch.marker_recorded[day].add(base)
+            timestamp = datetime.strptime(base, '%Y%m%d_%H%M%S')
+            start = time()
+            try:
+                # Arrowには全列を書き出すので、そのときだけ全部読む
+                if tasks['arrow']:
+                    trs = tracer.read_trace(self.source(base))
+                    series = trs[column]
+                    if freq_range is not None:
+                        series = series.loc[freq_range[0]:freq_range[1]]
+                else:
+                    series = tracer.read_trace(self.source(base),
+                                               usecols=column,
+                                               freq_range=freq_range)[column]
+            except Exception as _e:
+                Slack().log(self.log.warning, f'{base}: 読み込みに失敗しました {_e}')
+                continue
+            if tasks['arrow']:
+                try:
+                    tracer.append_arrow(
+                        self.arrowdirectory / f'spectra_{day}.arrows', trs,
+                        timestamp)
+                except (ValueError, OSError) as _e:  # pa.ArrowInvalidはValueError
+                    Slack().log(self.log.warning, f'{base}: {_e}')
+            if tasks['alert']:
+                for msg in self.get_detector().update(
+                        series, tracer.title_renamer(base)):
+                    Slack().mention(self.log.warning, msg)
+            if tasks['stats']:
+                try:
+                    report.append_marker_stats(
+                        report.stats_filename(self.markerdirectory, day),
+                        timestamp,
+                        report.marker_stats(series, Watch.config.markers))
+                except Exception as _e:  # 統計の失敗で描画を止めない
+                    Slack().log(self.log.warning,
+                                f'{base}: マーカー統計の書き出しに失敗しました {_e}')
+                else:
+                    appended.add(day)
+            self.timing.debug('process_sweep',
+                              extra={
+                                  'file': base,
+                                  'elapsed': time() - start
+                              })
+        self.rebuild_sn_reports(appended)
+        return False
+
+    def rebuild_sn_reports(self, days: Set[str]):
+        """最終版のウォーターフォール(とS/N比レポート)を書き出した後で
+        マーカー統計を追記した日の月のレポートを作り直す(月ごとに1回)
+        """
+        months = {
+            day[:6]: day
+            for day in sorted(days) if Path(
+                f'{self.directory}/waterfall_{day}.{Watch.config.file_format}'
+            ).exists()
+        }
+        for day in months.values():
+            self.save_sn_report(day)
+
+    def unexported(self,
+                   base: str,
+                   done: Dict[str, Optional[set]],
+                   day: str,
+                   filename: Path,
+                   timestamps,
+                   repair=None) -> bool:
+        """baseがdayのfilenameにまだ書き出されていなければTrue
+        起動後初めての日付は書き出し済みの時刻をtimestamps(filename)で読む
+        filenameが読めず直せもしないときはその日の書き出しを止める(False)
+        """
+        if day not in done:
+            stamps = self.read_exported(filename, timestamps, repair)
+            done[day] = None if stamps is None else {
+                t.strftime('%Y%m%d_%H%M%S')
+                for t in stamps
+            }
+        return done[day] is not None and base not in done[day]
+
+    def read_exported(self, filename: Path, timestamps, repair=None):
+        """filenameに書き出し済みの時刻のリスト
+        書き込み中に落ちて読めないときはrepair(filename)で切り詰めて読み直し、
+        直せなければ別名に退避して空のファイルとして扱う。
+        退避もできなければ警告してNone
+        """
+        if not filename.exists():
+            return []
+        try:
+            return timestamps(filename)
+        except Exception as _e:
+            error = _e
+        if repair is not None:
+            try:
+                dropped = repair(filename)
+                stamps = timestamps(filename)
+            except Exception as _e:
+                error = _e
+            else:
+                Slack().log(self.log.warning,
+                            f'{filename}: 途中で切れた{dropped}バイトを切り詰めました')
+                return stamps
+        broken = filename.with_name(
+            f'{filename.name}.broken_{datetime.now():%y%m%d_%H%M%S}')
+        try:
+            filename.rename(broken)
+        except OSError as _e:
+            Slack().log(self.log.error,
+                        f'{filename}: 読み込みに失敗したので書き出しを止めます {error} {_e}')
+            return None
+        Slack().log(self.log.warning,
+                    f'{filename}: 読み込みに失敗したので{broken.name}に退避しました {error}')
+        return []
+
+    def save_spectrum_plot(self, files: List[str],
+                           deadline=float('inf')) -> bool:
+        """filesのスペクトラムを描画する
+        deadline(time()の値)を過ぎたら残りは次のループに回してTrueを返す
+        """
         for base in files:
+            if time() > deadline:
+                return True
+            self.keep_leases()
             if self.debug:
-                Slack().log(print, f'[DEBUG] base file name {update_files}')
+                Slack().log(print, f'[DEBUG] base file name {base}')
+            if not self.claim(f'spectrum_{base}'):
+                continue  # 他のマシンが描画中
+            if self.leases is not None and Path(
+                    f'{self.directory}/{base}.png').exists():
+                self.release(f'spectrum_{base}')  # 他のマシンが描画済み
+                continue
+            start = time()
             try:
-                plot_onefile(
-                    base + '.txt',
+                self.renderer.run(
+                    plot_onefile,
+                    Watch.sources.get(base, f'{base}.txt'),
                     directory=self.directory,
-                    color=Watch.config.color,
-                    linewidth=Watch.config.linewidth,
-                    figsize=Watch.config.figsize,
-                    shownoise=Watch.config.shownoise,
-                    xticks_major_gap=Watch.config.xticks_major_gap,
-                    xticks_minor_gap=Watch.config.xticks_minor_gap,
-                    ylim=(
-                        Watch.config.ymin,
-                        Watch.config.ymax,
-                    ),
-                    yticks=np.arange(
-                        Watch.config.ymin,
-                        Watch.config.ymax + Watch.config.ystep,
-                        Watch.config.ystep,
-                    ),
-                    ylabel='dBm',
-                    markers=Watch.config.markers,
+                    data=Watch.streamed.get(base),
+                    **plot_options(Watch.config),
                 )
             except ZeroDivisionError as _e:
                 Slack().log(self.log.warning,
                             f'{base}: {_e}, txtファイルは送信されてきましたがデータが足りません')
+            except Exception as _e:  # 1ファイルの描画失敗で監視を止めない
+                Slack().log(self.log.error, f'{base}: 描画に失敗しました {_e}')
+            else:
+                self.timing.debug('spectrum',
+                                  extra={
+                                      'file': base,
+                                      'elapsed': time() - start
+                                  })
+            self.release(f'spectrum_{base}')
             # oneplog の画像のslack通知を定義している文
             # oneplog の画像のslack通知はrate limit exceedとならないように控える
             # else:
@@ -255,33 +852,45 @@ class Watch:
             # msg = f'画像の出力に成功しました {filename}'
             # Slack().log(self.log.info, msg)
             # Slack().upload(msg, filename)
-            finally:
-                plt.close()
-            # Reset count
-            Watch.no_update_count = 0
-            Watch.no_update_threshold = 2
-        else:  # update_filesが空で、更新がないとき
-            Watch.no_update_count += 1
-            if Watch.no_update_count > Watch.no_update_threshold:
-                msg = self.no_update_warning()
-                Slack().mention(self.log.warning, msg)
-                Watch.no_update_threshold *= 2
-
-    def save_heatmap_plot(self, txts: List[str]):
-        days_set = {_[:8] for _ in txts}
+        return False
+
+    def save_heatmap_plot(self, days: List[str],
+                          deadline=float('inf')) -> bool:
+        """daysのウォーターフォールを描画する
+        deadline(time()の値)を過ぎたら残りは次のループに回してTrueを返す
+        """
         if self.debug:
-            Slack().log(print, f'[DEBUG] day_set: {days_set}')
-        # txts directory 内にある%Y%m%dのsetに対して実行
-        for day in days_set:
+            Slack().log(print, f'[DEBUG] day_set: {days}')
+        # txts directory 内にある%Y%m%dに対して実行
+        for day in days:
+            if time() > deadline:
+                return True
+            self.keep_leases()
+            Watch.pending_days.discard(day)
             # waterfall_{day}.pngが存在すれば最終処理が完了しているので
             # waterfallをプロットしない -> 次のfor iterへ行く
             if Path(f'{self.directory}/waterfall_{day}.{Watch.config.file_format}'
                     ).exists():
+                Watch.stream_traces.pop(day, None)
+                self.memory.finalize(day)
                 continue
+            if not self.claim(f'waterfall_{day}'):
+                continue  # 他のマシンが描画中
+            self.memory.touch(day)
             # waterfall_{day}.pngが存在しなければ最終処理が完了していないので
             # waterfalll_{day}_update.pngを作成する
 
-            files = glob.glob(f'{day}_*.txt')
+            files = [
+                f for base, f in Watch.sources.items()
+                if base.startswith(f'{day}_') and self.is_ready(f)
+            ]
+            # ソケットで受け取ったスイープ(同じ時刻のファイルがあればファイルを使う)
+            stems = {tracer.trace_stem(f) for f in files}
+            streamed = {
+                base: trs
+                for base, trs in Watch.stream_traces.get(day, {}).items()
+                if base not in stems
+            }
             if self.debug:
                 Slack().log(
                     print, '[DEBUG] {}--LAST FILES-- {}'.format(
@@ -292,41 +901,130 @@ class Watch:
             # waterfall_update.pngが存在して、
             # かつ
             # ファイルに更新がなければ次のfor iterへ行く
-            noupdate = set(Watch.last_files[day]) == set(files)
-            exists = Path(
+            noupdate = set(Watch.last_files[day]) == set(files) | set(streamed)
+            update = Path(
                 f'{self.directory}/waterfall_{day}_update.{Watch.config.file_format}'
-            ).exists()
+            )
+            exists = update.exists()
+            rendered = stems | set(streamed)
+            if self.leases is not None and exists:
+                # 他のマシンが描画したときは描画に使ったファイル名が同じなら更新しない
+                # (最終更新時刻を引き継ぐコピーではtxtファイルの方が古く見える)
+                noupdate |= self.rendered(day) == rendered
             if exists and noupdate:
+                Watch.last_files[day] = files + sorted(streamed)
+                self.release(f'waterfall_{day}')
                 continue
-            Watch.last_files[day] = files
+            Watch.last_files[day] = files + sorted(streamed)
 
             # ファイルに更新があれば更新したwaterfall_update.pngを出力
-            trss = tracer.read_traces(*files, usecols=Watch.config.usecols)
-
-            # configで snがTrueの場合はS/N比になおす
-            if Watch.config.sn:
-                trss = trss.sn_ratio()
-
-            # 特定の周波数のスペクトラムにマーカーを打つため、マーカーをセット
-            trss.markers = Watch.config.markers
-            if self.debug:
-                Slack().log(print, f'[DEBUG] {trss}')
-                Slack().log(print, f'[DEBUG] {trss.markers}')
+            # usecolsの全列を1回の読み込みで読む
+            usecols = Watch.usecols()
+            start = time()
+            columns = tracer.read_traces(*files,
+                                         usecols=usecols,
+                                         max_workers=getattr(
+                                             Watch.config, 'read_workers', 8),
+                                         freq_range=getattr(
+                                             Watch.config, 'freq_range', None))
+            for f, _e in columns[usecols[0]].attrs['errors'].items():
+                Slack().log(self.log.warning, f'{f}: 読み込みに失敗しました {_e}')
+            self.timing.debug('read_traces',
+                              extra={
+                                  'file': day,
+                                  'files': len(files),
+                                  'elapsed': time() - start
+                              })
 
             _n = DAY_SECOND // Watch.config.transfer_rate  # => 288
-            num_of_files_ok = len(files) >= _n
+            num_of_files_ok = len(Watch.last_files[day]) >= _n
             if self.debug:
                 Slack().log(print, f'[DEBUG] limit: {_n}')
-                Slack().log(print, f'[DEBUG] length: {len(files)}')
+                Slack().log(print,
+                            f'[DEBUG] length: {len(Watch.last_files[day])}')
+
+            saved = True
+            for column, trss in columns.items():
+                self.keep_leases()
+                if streamed:
+                    trss = Watch.merge_streamed(
+                        trss, {b: df[column]
+                               for b, df in streamed.items()})
+                if not self.save_day_column(day, column, trss,
+                                            num_of_files_ok):
+                    Watch.last_files.pop(day, None)  # 次のループで再試行
+                    Watch.pending_days.add(day)
+                    saved = False
+            if saved and self.leases is not None:
+                self.save_rendered(day, rendered)
+            if saved and num_of_files_ok:
+                self.memory.finalize(day)
+            self.release(f'waterfall_{day}')
+        return False
+
+    def rendered_filename(self, day: str) -> Path:
+        """dayのウォーターフォールの描画に使ったファイル名の記録"""
+        return self.directory / f'.waterfall_{day}.rendered'
+
+    def rendered(self, day: str) -> Optional[Set[str]]:
+        """dayのウォーターフォールの描画に使ったファイル名(拡張子なし)
+        どのマシンも描画していないか、読めなければNone
+        """
+        try:
+            return set(json.loads(self.rendered_filename(day).read_text()))
+        except (OSError, ValueError):
+            return None
+
+    def save_rendered(self, day: str, rendered: Set[str]):
+        """dayのウォーターフォールの描画に使ったファイル名を記録して他のマシンと共有する"""
+        try:
+            with atomic_path(self.rendered_filename(day)) as tmp:
+                tmp.write_text(json.dumps(sorted(rendered)))
+        except OSError as _e:
+            Slack().log(self.log.warning,
+                        f'{self.rendered_filename(day)}: 書き出しに失敗しました {_e}')
+
+    def save_day_column(self, day: str, column: str, trss: tracer.Trace,
+                        num_of_files_ok: bool) -> bool:
+        """dayのcolumn列のウォーターフォールを描画する
+        usecolsの2列目以降はファイル名に_{列名}をつける
+        描画に失敗したらFalseを返す
+        """
+        primary = column == Watch.usecols()[0]
+        suffix = '' if primary else f'_{column}'
+        raw = trss  # ロールアップはS/N比に直す前のデータから作る
+        if self.cache is not None:
+            self.cache.update(day,
+                              raw,
+                              markers=Watch.config.markers,
+                              column=None if primary else column)
+
+        # configで snがTrueの場合はS/N比になおす
+        if Watch.config.sn:
+            trss = trss.sn_ratio()
 
-            # ファイル名の決定
-            filename: Path = self.filename_resolver(
-                yyyymmdd=day,
-                remove_flag=num_of_files_ok,
-                ext=Watch.config.file_format)
+        # 特定の周波数のスペクトラムにマーカーを打つため、マーカーをセット
+        trss.markers = Watch.config.markers
+        if self.debug:
+            Slack().log(print, f'[DEBUG] {trss}')
+            Slack().log(print, f'[DEBUG] {trss.markers}')
+
+        # ファイル名の決定
+        filename: Path = self.filename_resolver(yyyymmdd=day,
+                                                remove_flag=num_of_files_ok,
+                                                ext=Watch.config.file_format,
+                                                suffix=suffix)
 
-            # ヒートマップの描画
-            trss.heatmap(
+        # ヒートマップの描画
+        start = time()
+        try:
+            self.renderer.run(
+                savefig,
+                filename,
+                Watch.config.dpi,
+                plot_heatmap,
+                pd.DataFrame(trss),
+                trss.markers,
                 title=f'{day[:4]}/{day[4:6]}/{day[6:8]}',
                 color=Watch.config.color,
                 xticks_major_gap=Watch.config.xticks_major_gap,
@@ -344,26 +1042,132 @@ class Watch:
                 cmaplevel=Watch.config.cmaplevel,
                 cmapstep=Watch.config.cmapstep,
                 extend=Watch.config.extend,
-            )
-            plt.savefig(
-                filename,
                 dpi=Watch.config.dpi,
+                rate=Watch.config.transfer_rate,
+                reduce=getattr(Watch.config, 'heatmap_reduce', 'max'),
             )
-            # ファイルに保存するときplt.close()しないと
-            # 複数プロットが1pngファイルに表示される
-            plt.close()  # reset plot
-            # logdi = self.log.debug if self.debug else
+        except Exception as _e:  # 1日分の描画失敗で監視を止めない
+            Slack().log(self.log.error, f'{filename}: 描画に失敗しました {_e}')
+            return False
+        self.timing.debug('heatmap',
+                          extra={
+                              'file': str(filename),
+                              'elapsed': time() - start
+                          })
+        # logdi = self.log.debug if self.debug else
+        if Watch.config.slack_post:
+            msg = f'画像の出力に成功しました {filename}'
+            Slack().log(self.log.info, msg)
+            Slack().upload(msg, str(filename))
+
+        # ズーム表示用のタイルピラミッドを更新
+        if getattr(Watch.config, 'tiles', False):
+            self.save_tiles(day, trss, suffix)
+
+        if not primary:
+            return True
+        # 1日分揃ったらロールアップを保存して長期ウォーターフォールを更新
+        if num_of_files_ok and getattr(Watch.config, 'rollup_freq', None):
+            self.save_longterm_plot(day, raw)
+        # 1日分揃ったらマーカー統計からその月のS/N比レポートを作る
+        if num_of_files_ok and getattr(Watch.config, 'marker_stats', False):
+            self.save_sn_report(day)
+
+        # データの抜けを検証"""
+        rate = '{}s'.format(Watch.config.transfer_rate)
+        droped_data = trss.guess_fallout(rate=rate)
+        if len(droped_data) > 0:
+            Slack().log(self.log.warning, f'データが抜けています {droped_data}')
+        return True
+
+    def save_sn_report(self, day: str):
+        """dayの月のマーカー統計をS/N比レポート(watchdog_SN.xlsx)に書き出す"""
+        start = time()
+        try:
+            stats = report.load_marker_stats(self.markerdirectory,
+                                             start=day[:6] + '01',
+                                             end=day[:6] + '31')
+            report.write_report(self.stats_file, report.sn_report(stats))
+        except Exception as _e:  # レポートの失敗で監視を止めない
+            Slack().log(self.log.error, f'{self.stats_file}: 書き出しに失敗しました {_e}')
+            return
+        self.timing.debug('sn_report',
+                          extra={
+                              'file': str(self.stats_file),
+                              'elapsed': time() - start
+                          })
+
+    @staticmethod
+    def merge_streamed(trss: tracer.Trace,
+                       streamed: Dict[str, pd.Series]) -> tracer.Trace:
+        """ファイルから読み込んだtrssに、ソケットで受け取ったスイープを列として加える"""
+        columns = pd.DataFrame({
+            datetime.strptime(base, '%Y%m%d_%H%M%S'): trs
+            for base, trs in streamed.items()
+        })
+        merged = tracer.Trace(
+            pd.concat([trss, columns], axis=1).sort_index(axis=1))
+        merged.attrs['errors'] = trss.attrs.get('errors', {})
+        return merged
+
+    def save_tiles(self, day: str, trss: tracer.Trace, suffix: str = ''):
+        """tiles_{day}{suffix}/ にウォーターフォールのタイルピラミッドを出力する
+        前回から増えた時刻のタイルだけを描き直す
+        """
+        directory = self.directory / f'tiles_{day}{suffix}'
+        try:
+            self.renderer.run(
+                tiles.update_tiles,
+                directory,
+                day,
+                pd.DataFrame(trss),
+                rate=Watch.config.transfer_rate,
+                cmap=Watch.config.cmap,
+                cmaphigh=Watch.config.cmaphigh,
+                cmaplow=Watch.config.cmaplow,
+                tile=getattr(Watch.config, 'tile_size', 256),
+            )
+        except Exception as _e:
+            Slack().log(self.log.error, f'{directory}: タイルの出力に失敗しました {_e}')
+
+    def save_longterm_plot(self, day: str, trss: tracer.Trace):
+        """1日分のロールアップを保存し、
+        config.longterm_daysに指定された日数(ex: [7, 30])ごとに
+        ロールアップだけから waterfall_{N}days.png を描画する
+        """
+        rollup.save_rollup(rollup.rollup_filename(self.rollupdirectory, day),
+                           rollup.make_rollup(trss, Watch.config.rollup_freq))
+        end = datetime.strptime(day, '%Y%m%d')
+        for ndays in getattr(Watch.config, 'longterm_days', []):
+            start = (end - timedelta(days=ndays - 1)).strftime('%Y%m%d')
+            rollups = rollup.load_rollups(self.rollupdirectory, start, day)
+            filename = Path(
+                f'{self.directory}/waterfall_{ndays}days.{Watch.config.file_format}'
+            )
+            try:
+                self.renderer.run(
+                    savefig,
+                    filename,
+                    Watch.config.dpi,
+                    rollup.plot_longterm,
+                    rollups,
+                    stat=getattr(Watch.config, 'rollup_stat', 'max'),
+                    title=f'{start}-{day}',
+                    figsize=Watch.config.h_figsize,
+                    cmap=Watch.config.cmap,
+                    cmaphigh=Watch.config.cmaphigh,
+                    cmaplow=Watch.config.cmaplow,
+                    cmapstep=Watch.config.cmapstep,
+                    extend=Watch.config.extend,
+                )
+            except Exception as _e:
+                Slack().log(self.log.error, f'{filename}: 描画に失敗しました {_e}')
+                continue
             if Watch.config.slack_post:
                 msg = f'画像の出力に成功しました {filename}'
                 Slack().log(self.log.info, msg)
                 Slack().upload(msg, str(filename))
 
-            # データの抜けを検証"""
-            rate = '{}min'.format(Watch.config.transfer_rate // 60)
-            droped_data = trss.guess_fallout(rate=rate)
-            if len(droped_data) > 0:
-                Slack().log(self.log.warning, f'データが抜けています {droped_data}')
-
 
 def parse():
     """引数解析"""
@@ -397,6 +1201,35 @@ def main():
     watchdog = Watch(args)
     Slack().log(watchdog.log.info,
                 f'ディレクトリの監視を開始しました。 SAtraceWatchdog {VERSION}')
+    # HTTP APIの起動
+    config = tracer.json_load_encode_with_bom(CONFIGFILE)
+    port = getattr(config, 'api_port', None)
+    if port is not None:
+        host = getattr(config, 'api_host', '127.0.0.1')
+        watchdog.cache = api.SpectrumCache(
+            max_days=getattr(config, 'api_max_days', 2))
+        watchdog.memory.register_evictor(watchdog.cache.evict, pressure=True)
+        api.serve(watchdog.cache, host=host, port=port)
+        Slack().log(watchdog.log.info, f'HTTP APIを開始しました http://{host}:{port}')
+    # ソケットからの受信の開始
+    address = getattr(config, 'ingest_address', None)
+    if address is not None:
+        watchdog.ingest = IngestServer(address,
+                                       archive=getattr(config, 'ingest_archive',
+                                                       None),
+                                       max_size=getattr(config,
+                                                        'ingest_max_size',
+                                                        8 * 1024**2))
+        watchdog.ingest.start()
+        Slack().log(watchdog.log.info, f'受信を開始しました {address}')
+    # 複数台での分担の開始
+    ttl = getattr(config, 'lease_ttl', None)
+    if ttl is not None:
+        watchdog.leases = LeaseManager(watchdog.directory / '.leases',
+                                       owner=getattr(config, 'node_id', None),
+                                       ttl=ttl)
+        Slack().log(watchdog.log.info,
+                    f'{watchdog.leases.owner}: 複数台での分担を開始しました')
     while True:
         try:
             watchdog.loop()
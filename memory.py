@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""長期間の運用でメモリ使用量を一定に保つ
+
+監視ツールは日付ごとの状態(ファイル名のリスト、書き出し済みの記録、受信データ)を
+クラス変数やキャッシュに持つ。何か月も動かし続けても増えていかないように、
+最終版のウォーターフォール(waterfall_{day}.png)を書き出した日の状態を
+最近使った順(LRU)に捨てる。
+
+* 最終処理が終わった日のうち、最近使ったkeep_days日分を残して古い日から捨てる
+* メモリ使用量(RSS)がbudget[MB]を超えたら、最終処理が終わった日をすべて捨て、
+  gc.collect()とmalloc_trim()でOSにメモリを返す
+* report_interval秒ごとにRSSの現在値と最大値、tracemallocの現在値と最大値、
+  前回から増えた割り当て場所の上位を報告する(tracemallocは有効にしたときだけ)
+
+USAGE:
+    governor = MemoryGovernor(budget=2048, keep_days=2)
+    governor.register(Watch.last_files)  # {day: ...}
+    governor.register(Watch.arrived, prefix=True)  # {'yyyymmdd_HHMMSS', ...}
+    governor.register_evictor(cache.evict, pressure=True)
+    governor.touch('20151111')
+    governor.finalize('20151111')
+    evicted = governor.collect()
+"""
+import ctypes
+import ctypes.util
+import gc
+import os
+import resource
+import tracemalloc
+from collections import OrderedDict
+from time import time
+from typing import Callable, List, Optional, Set
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def rss_mb() -> float:
+    """このプロセスの現在のメモリ使用量[MB]
+    /procがなければ最大値で代用する
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE / 1024**2
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    """このプロセスの最大メモリ使用量[MB]"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def malloc_trim():
+    """解放済みのメモリをOSに返す(glibcのみ、それ以外は何もしない)"""
+    name = ctypes.util.find_library('c')
+    try:
+        ctypes.CDLL(name).malloc_trim(0)
+    except (OSError, AttributeError, TypeError):
+        pass
+
+
+class MemoryGovernor:
+    """日付ごとの状態をLRUで捨て、メモリ使用量を報告する
+
+    >>> last_files = {'20151110': ['a'], '20151111': ['b'], '20151112': ['c']}
+    >>> detected = {'20151110_000000', '20151111_000000', '20151112_000000'}
+    >>> governor = MemoryGovernor(keep_days=1)
+    >>> governor.register(last_files)
+    >>> governor.register(detected, prefix=True)
+    >>> for day in ['20151110', '20151111', '20151112']:
+    ...     governor.touch(day)
+    >>> governor.finalize('20151110')
+    >>> governor.finalize('20151111')
+    >>> governor.touch('20151110')  # 最近使った日は残す
+    >>> governor.collect()
+    ['20151111']
+    >>> sorted(last_files), sorted(detected)
+    (['20151110', '20151112'], ['20151110_000000', '20151112_000000'])
+    >>> governor.evicted
+    {'20151111'}
+    """
+
+    def __init__(self,
+                 budget: Optional[float] = None,
+                 keep_days: int = 2,
+                 report_interval: float = 3600,
+                 trace: bool = False):
+        """
+        budget: メモリ使用量の上限[MB]。Noneで上限なし(keep_daysだけで捨てる)
+        keep_days: 最終処理が終わった日の状態を残す日数
+        report_interval: メモリ使用量を報告する間隔[sec]
+        trace: tracemallocでPythonの割り当てを追跡する(遅くなる)
+        """
+        self.budget = budget
+        self.keep_days = keep_days
+        self.report_interval = report_interval
+        # (コンテナ, 日付で始まるキーも捨てるか)
+        self._states: List[tuple] = []
+        # 日付ごとに捨てる処理(キャッシュなど) (evict, budgetを超えたときだけか)
+        self._evictors: List[tuple] = []
+        # 最近使った順の日付 {day: 最終処理が終わったか}
+        self._days: OrderedDict = OrderedDict()
+        # 状態を捨てた日付
+        self.evicted: Set[str] = set()
+        self.peak = 0.0
+        self._last_report = time()
+        self._snapshot = None
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._snapshot = tracemalloc.take_snapshot()
+
+    def register(self, state, prefix: bool = False):
+        """日付ごとの状態を登録する
+        state: 日付をキーにするdictかset
+        prefix: Trueのときは日付で始まるキー(ファイル名)も捨てる
+        """
+        self._states.append((state, prefix))
+
+    def register_evictor(self,
+                         evict: Callable[[str], None],
+                         pressure: bool = False):
+        """evict(day)で日付の状態を捨てる処理を登録する
+        pressure: Trueのときはbudgetを超えたときだけ呼ぶ(キャッシュなど)
+        """
+        self._evictors.append((evict, pressure))
+
+    def touch(self, day: str):
+        """dayを使った"""
+        self._days[day] = self._days.get(day, False)
+        self._days.move_to_end(day)
+        self.evicted.discard(day)
+
+    def finalize(self, day: str):
+        """dayの最終処理が終わった(捨ててよい)
+        既に捨てた日は何もしない
+        """
+        if day not in self.evicted:
+            self._days[day] = True
+
+    def evict(self, day: str, pressure: bool = False):
+        """dayの状態をすべて捨てる
+        pressure: budgetを超えたときの処理も呼ぶ
+        """
+        for state, prefix in self._states:
+            if isinstance(state, dict):
+                state.pop(day, None)
+            else:
+                state.discard(day)
+            if prefix:
+                for key in [k for k in state if str(k).startswith(day)]:
+                    if isinstance(state, dict):
+                        del state[key]
+                    else:
+                        state.discard(key)
+        for evict, only_pressure in self._evictors:
+            if pressure or not only_pressure:
+                evict(day)
+        self._days.pop(day, None)
+        self.evicted.add(day)
+
+    def collect(self) -> List[str]:
+        """最終処理が終わった日の状態を捨て、捨てた日付を返す
+        keep_days日分を超えた古い日と、budgetを超えたときはすべて
+        """
+        final = [day for day, done in self._days.items() if done]  # 古い順
+        over = self.budget is not None and rss_mb() > self.budget
+        victims = final if over else final[:max(len(final) - self.keep_days, 0)]
+        for day in victims:
+            self.evict(day, pressure=over)
+        if over:
+            gc.collect()
+            malloc_trim()
+        return victims
+
+    def over_budget(self) -> bool:
+        """捨てられるものを捨ててもbudgetを超えているときTrue"""
+        return self.budget is not None and rss_mb() > self.budget
+
+    def due(self) -> bool:
+        """前回の報告からreport_interval秒経ったらTrue"""
+        return time() - self._last_report >= self.report_interval
+
+    def report(self, top: int = 5) -> dict:
+        """メモリ使用量の現在値と最大値
+        tracemallocを有効にしたときは前回の報告から増えた割り当て場所の上位topも返す
+        """
+        self._last_report = time()
+        rss = rss_mb()
+        self.peak = max(self.peak, rss)
+        result = {
+            'rss': round(rss, 1),
+            'rss_peak': round(max(self.peak, peak_rss_mb()), 1),
+            'days': len(self._days),
+            'evicted': len(self.evicted),
+        }
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            result['traced'] = round(current / 1024**2, 1)
+            result['traced_peak'] = round(peak / 1024**2, 1)
+            snapshot = tracemalloc.take_snapshot()
+            if self._snapshot is not None:
+                stats = snapshot.compare_to(self._snapshot, 'lineno')[:top]
+                result['growth'] = [
+                    f'{s.traceback[0].filename}:{s.traceback[0].lineno} '
+                    f'{s.size_diff / 1024:+.0f}KiB' for s in stats
+                ]
+            self._snapshot = snapshot
+        return result
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
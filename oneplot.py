@@ -25,6 +25,14 @@ plot_onefile('data/20161108_020104.txt')`
 $ python oneplot.py -d data data/*.txt`
 ```
 
+`--jobs`(`-j`)で並列実行するプロセス数を指定できる。
+pngファイルがtxtファイルより新しいときはスキップする(`--force`で再描画)。
+config.json(`--config`, 既定は環境変数`WATCH_CONFIG`)のスペクトラムプロットのオプションを使う。
+
+```sh
+$ python oneplot.py -j 4 -d png data/*.txt
+```
+
 python上ではforを使わないといけない。
 oneplot.pyの`main()`ではforが使われているからコンソール上では
 上記のようにアスタリスク指定が出来る。
@@ -36,12 +44,20 @@ for i in glob.glob('../data/*.txt')
 ```
 
 """
+import io
+import os
 from pathlib import Path
 from typing import Optional
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
-from SAtraceWatchdog.tracer import read_trace, title_renamer, Trace, set_xticks
+from tqdm import tqdm
+from SAtraceWatchdog.tracer import (read_trace, title_renamer, Trace,
+                                    set_xticks, json_load_encode_with_bom,
+                                    trace_stem)
+from SAtraceWatchdog.lease import atomic_path
 
 # グラフ描画オプション
 
@@ -61,57 +77,102 @@ def seaborn_option():
 
 def plot_onefile(filename,
                  directory=Path.cwd(),
-                 column: str = 'AVER',
+                 column='AVER',
                  shownoise: bool = True,
                  xticks_major_gap: Optional[float] = None,
                  xticks_minor_gap: Optional[float] = None,
                  ylabel: Optional[str] = None,
                  markers: list[float] = [],
+                 freq_range: Optional[tuple[float, float]] = None,
+                 data: Optional[str] = None,
                  *args,
                  **kwargs):
     """スペクトラムファイル1ファイルをプロットします。
     directoryが指定されてたら、その場所に同じベースネームでpng形式に保存します。
+    freq_rangeに(最小周波数, 最大周波数)を指定すると、その範囲だけを読み込んでプロットします。
+    dataにtxtファイルの中身を渡すと、filenameは読まずにファイル名にだけ使います。
+    columnに['AVER', 'MAXH']のようにリストを渡すと、1回読み込んで列ごとにプロットし、
+    2列目以降は{ベースネーム}_{列名}.pngに保存します。
     """
+    columns = [column] if isinstance(column, str) else list(column)
     seaborn_option()
     # ファイルからデータを読み込む
-    df = read_trace(filename)
-    # カラムを一つ選択
-    select = Trace(df[column])
-    # マーカーを定義
-    select.markers = markers
-
-    # Base chart
-    ax = select.plot(title=title_renamer(filename),
-                     legend=False,
-                     *args,
-                     **kwargs)
-
-    # Generate array of grid & label
-    set_xticks(
-        ax,
-        xticks_major_gap,
-        xticks_minor_gap,
-        min(df.index),
-        max(df.index),
-    )
-    if ylabel is not None:
-        plt.ylabel(ylabel)
-
-    select.plot_markers(ax=ax, legend=False)
-    if shownoise:
-        select.plot_noisefloor()
-    base = Path(filename).stem
-    plt.savefig(f'{directory}/{base}.png')
-    # ファイルに保存する時plt.close()しないと
-    # 複数プロットが1pngファイルに表示される
-    plt.close()  # reset plot
+    source = filename if data is None else io.StringIO(data)
+    df = read_trace(source, usecols=columns, freq_range=freq_range)
+    base = trace_stem(filename)
+    for i, col in enumerate(columns):
+        # カラムを一つ選択
+        select = Trace(df[col])
+        # マーカーを定義
+        select.markers = markers
+
+        # Base chart
+        # 横ピクセル数より多い点は描画しても見えないので間引く
+        figsize = kwargs.get('figsize', plt.rcParams['figure.figsize'])
+        width = int(figsize[0] * plt.rcParams['figure.dpi'])
+        ax = select.decimate(width).plot(title=title_renamer(filename),
+                                         legend=False,
+                                         *args,
+                                         **kwargs)
+
+        # Generate array of grid & label
+        set_xticks(
+            ax,
+            xticks_major_gap,
+            xticks_minor_gap,
+            min(df.index),
+            max(df.index),
+        )
+        if ylabel is not None:
+            plt.ylabel(ylabel)
+
+        select.plot_markers(ax=ax, legend=False)
+        if shownoise:
+            select.plot_noisefloor()
+        suffix = '' if i == 0 else f'_{col}'
+        with atomic_path(f'{directory}/{base}{suffix}.png') as tmp:
+            plt.savefig(tmp)
+        # ファイルに保存する時plt.close()しないと
+        # 複数プロットが1pngファイルに表示される
+        plt.close()  # reset plot
     return ax
 
 
+def plot_options(config) -> dict:
+    """config.jsonのスペクトラムプロットのオプションを
+    plot_onefile()のキーワード引数にして返す
+    """
+    options = {
+        'column': getattr(config, 'usecols', 'AVER'),
+        'ylabel': 'dBm',
+        'markers': getattr(config, 'markers', []),
+        'freq_range': getattr(config, 'freq_range', None),
+    }
+    for key in ('color', 'linewidth', 'figsize', 'shownoise',
+                'xticks_major_gap', 'xticks_minor_gap'):
+        if hasattr(config, key):
+            options[key] = getattr(config, key)
+    if all(hasattr(config, key) for key in ('ymin', 'ymax', 'ystep')):
+        options['ylim'] = (config.ymin, config.ymax)
+        options['yticks'] = np.arange(config.ymin, config.ymax + config.ystep,
+                                      config.ystep)
+    return options
+
+
+def is_uptodate(filename, directory) -> bool:
+    """pngファイルがtxtファイルより新しければTrue"""
+    png = Path(directory) / f'{trace_stem(filename)}.png'
+    return png.exists() and png.stat().st_mtime >= Path(filename).stat().st_mtime
+
+
 def main():
     """entry point
     引数の解釈をして、
-    plot_onefile()に指定されたファイル名をforで渡します。
+    plot_onefile()に指定されたファイル名を渡します。
+
+    * --jobs で指定したプロセス数で並列にプロットします。
+    * pngファイルがtxtファイルより新しければスキップします(--forceで再描画)。
+    * config.jsonのスペクトラムプロットのオプションを使います。
     """
     parser = argparse.ArgumentParser(
         description='スペクトラム情報が記されたテキストファイルをプロットします')
@@ -124,18 +185,63 @@ def main():
         '-d',
         '--directory',
         help='保存ディレクトリの指定',
+        default=Path.cwd(),
     )
     parser.add_argument(
         '-c',
         '--column',
-        help='グラフ化する列指定',
-        default='AVER'  # 'MAXH', 'MINH'
+        help='グラフ化する列指定。複数指定可能(既定はconfigのusecols, なければAVER)',
+        nargs='+',
+        default=None  # 'AVER', 'MAXH', 'MINH'
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help='並列に実行するプロセス数',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--config',
+        help='プロットのオプションを読み込むconfig.json',
+        default=os.getenv("WATCH_CONFIG", "./config/config.json"),
+    )
+    parser.add_argument(
+        '-f',
+        '--force',
+        help='pngファイルが新しくても再描画する',
+        action='store_true',
     )
     args = parser.parse_args()
 
+    options = {}
+    if os.path.exists(args.config):
+        options = plot_options(json_load_encode_with_bom(args.config))
+    if args.column is not None:
+        options['column'] = args.column
+    files = [
+        f for f in args.files
+        if args.force or not is_uptodate(f, args.directory)
+    ]
+    print(f'{len(args.files) - len(files)} files are up to date, '
+          f'plot {len(files)} files')
+
     # 引数で渡されたtxtファイルをプロット
-    for filename in args.files:
-        plot_onefile(filename, directory=args.directory, column=args.column)
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {
+            executor.submit(plot_onefile,
+                            filename,
+                            directory=args.directory,
+                            **options): filename
+            for filename in files
+        }
+        with tqdm(total=len(futures), unit='files') as pbar:
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as _e:
+                    tqdm.write(f'{futures[future]}: {_e}')
+                pbar.update()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""描画用ワーカープロセス
+
+matplotlibの描画を監視プロセスとは別のプロセスで実行する。
+長期間の運用でメモリが増えていかないように、
+ワーカーはmax_jobs回の描画、またはmax_rss[MB]を超えたら作り直す。
+描画がtimeout秒で終わらなければワーカーを強制終了してTimeoutErrorを返す。
+
+USAGE:
+    renderer = Renderer(max_jobs=100, max_rss=1024, timeout=300)
+    try:
+        renderer.run(plot_onefile, '20161108_020104.txt', directory='png')
+    except TimeoutError:
+        ...
+    renderer.stop()
+"""
+import multiprocessing
+import resource
+from typing import Optional
+import pandas as pd
+import matplotlib.pyplot as plt
+from SAtraceWatchdog.tracer import Trace
+from SAtraceWatchdog.lease import atomic_path
+
+
+def plot_heatmap(trss: pd.DataFrame, markers: list[float], **kwargs):
+    """Trace.heatmap()のラッパー
+    pickleでTraceのmarkersは失われるので、ワーカー側でセットし直す
+    """
+    trss = Trace(trss)
+    trss.markers = markers
+    return trss.heatmap(**kwargs)
+
+
+def savefig(filename, dpi, plot, /, *args, **kwargs):
+    """plot(*args, **kwargs)で描画した図をfilenameに保存する
+    一時ファイルに保存してから名前を変えるので、書き込み途中のファイルは見えない
+    """
+    plot(*args, **kwargs)
+    with atomic_path(filename) as tmp:
+        plt.savefig(tmp, dpi=dpi)
+
+
+def _worker(conn):
+    """ワーカープロセスのメインループ
+    (func, args, kwargs)を受け取って実行し、
+    (発生したエラー, 最大RSS[MB])を送り返す。
+    Noneを受け取ったら終了する。
+    """
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        func, args, kwargs = job
+        err = None
+        try:
+            func(*args, **kwargs)
+        except Exception as _e:  # エラーは監視プロセス側で処理する
+            err = _e
+        finally:
+            # ファイルに保存する時plt.close()しないと
+            # 複数プロットが1pngファイルに表示される
+            plt.close('all')
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        try:
+            conn.send((err, rss))
+        except Exception:  # pickleできないエラー
+            conn.send((RuntimeError(repr(err)), rss))
+
+
+class Renderer:
+    """描画用ワーカープロセスを1つ管理する"""
+
+    def __init__(self,
+                 max_jobs: int = 100,
+                 max_rss: float = 1024,
+                 timeout: float = 300):
+        """
+        max_jobs: ワーカーを作り直すまでの描画回数
+        max_rss: ワーカーを作り直すメモリ使用量[MB]
+        timeout: 1回の描画のタイムアウト[sec]
+        """
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.timeout = timeout
+        self.jobs = 0
+        # 直前の描画後のワーカーの最大メモリ使用量[MB]
+        self.rss = 0.0
+        self.process: Optional[multiprocessing.Process] = None
+        self.conn = None
+
+    def start(self):
+        """ワーカープロセスを起動する"""
+        ctx = multiprocessing.get_context('spawn')
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_worker, args=(child, ), daemon=True)
+        self.process.start()
+        child.close()
+        self.jobs = 0
+
+    def stop(self, kill: bool = False):
+        """ワーカープロセスを終了する
+        kill=Trueのときは描画中でも強制終了する
+        """
+        if self.process is None:
+            return
+        if not kill and self.process.is_alive():
+            try:
+                self.conn.send(None)
+                self.process.join(timeout=10)
+            except (BrokenPipeError, OSError):
+                pass
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+        self.process, self.conn = None, None
+
+    def run(self, func, *args, **kwargs):
+        """func(*args, **kwargs)をワーカープロセスで実行する
+        funcで発生したエラーはそのまま送出する。
+        timeout秒以内に終わらなければTimeoutError,
+        ワーカーが異常終了したらRuntimeErrorを送出する。
+        """
+        if self.process is None or not self.process.is_alive():
+            self.stop(kill=True)
+            self.start()
+        self.conn.send((func, args, kwargs))
+        if not self.conn.poll(self.timeout):
+            self.stop(kill=True)
+            raise TimeoutError(f'描画が{self.timeout}秒以内に終わりませんでした')
+        try:
+            err, rss = self.conn.recv()
+        except EOFError:
+            self.stop(kill=True)
+            raise RuntimeError('描画プロセスが異常終了しました') from None
+        self.jobs += 1
+        self.rss = rss
+        # 描画回数かメモリ使用量が上限を超えたらワーカーを作り直す
+        if self.jobs >= self.max_jobs or rss > self.max_rss:
+            self.stop()
+        if err is not None:
+            raise err
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""監視ツールの負荷試験用のリプレイ
+
+保存済みのtxtファイルを、ファイル名の時刻(%Y%m%d_%H%M%S)の間隔のspeed倍速で
+作業用のtxtディレクトリに置き直し、監視ツールの処理を計測する。
+
+* 停止(--outage): 期間内のファイルを止めておき、期間の終わりにまとめて届ける
+* 欠損(--gap): 期間内のファイルを届けない
+* 書き込み途中(--partial): 割合pのファイルを半分だけ書き、--partial-delay秒後に残りを書く
+* 複数台の測定器(-iを複数指定): 測定器ごとにtxtディレクトリとpngディレクトリを指定する
+* ソケットで送る(--ingest): txtディレクトリに置く代わりにIngestServerに送る
+
+計測するもの
+* 遅延: txtファイルを置いてから{ファイル名}.pngができるまでの時間(sec)
+* 未処理数: 置いたファイルのうちpngがまだないファイル数
+* 監視ツール(子プロセスを含む)のCPU使用率(%)とメモリ使用量(MB)
+  /procから読むのでLinuxのみ
+
+USAGE:
+    # 60倍速で再生し、監視ツールを起動して計測
+    $ python replay.py -i archive data png --speed 60 \\
+        --command "python main.py -d png" --output replay.csv
+
+    # 01:00から2時間停止したあとにまとめて届き、1割のファイルは書き込み途中
+    $ python replay.py -i archive data png --speed 60 --pid 12345 \\
+        --outage 20151111_010000 7200 --partial 0.1
+"""
+import argparse
+import os
+import random
+import shlex
+import signal
+import subprocess
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import sleep, time
+from typing import Dict, List, NamedTuple, Optional
+import numpy as np
+import pandas as pd
+from SAtraceWatchdog.tracer import find_traces, open_trace
+from SAtraceWatchdog.ingest import send
+
+TIME_FORMAT = '%Y%m%d_%H%M%S'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+class Delivery(NamedTuple):
+    """1ファイル分の配送予定"""
+    at: float  # 再生開始からの経過時間(sec)
+    name: str  # 拡張子なしのファイル名 %Y%m%d_%H%M%S
+    src: str  # 保存済みのファイル
+    dest: Path  # 置き直すtxtディレクトリ
+    png: Optional[Path]  # 遅延を計測するpngディレクトリ
+    partial: bool  # 書き込み途中の状態を作る
+
+
+def in_windows(t: datetime, windows: List[tuple]) -> Optional[datetime]:
+    """tを含む(開始, 秒数)の期間の終わり。含まなければNone"""
+    for start, seconds in windows:
+        end = start + timedelta(seconds=seconds)
+        if start <= t < end:
+            return end
+    return None
+
+
+def schedule(sources: Dict[str, str],
+             dest,
+             png=None,
+             speed: float = 1,
+             origin: Optional[datetime] = None,
+             outages: List[tuple] = (),
+             gaps: List[tuple] = (),
+             partial: float = 0,
+             rng: Optional[random.Random] = None) -> List[Delivery]:
+    """sources({ファイル名: パス})の配送予定を作る
+    origin(既定は最初のファイルの時刻)からの経過時間をspeedで割った時刻に届ける
+    speed=0のときは待たずに届ける
+
+    >>> files = {'20151111_000000': 'a', '20151111_000500': 'b',
+    ...          '20151111_001000': 'c', '20151111_001500': 'd'}
+    >>> outage = [(datetime(2015, 11, 11, 0, 5), 300)]
+    >>> for d in schedule(files, 'data', speed=60, outages=outage):
+    ...     print(d.at, d.name)
+    0.0 20151111_000000
+    10.0 20151111_000500
+    10.0 20151111_001000
+    15.0 20151111_001500
+    >>> gap = [(datetime(2015, 11, 11, 0, 5), 300)]
+    >>> [d.name for d in schedule(files, 'data', gaps=gap)]
+    ['20151111_000000', '20151111_001000', '20151111_001500']
+    """
+    rng = rng or random.Random()
+    times = {name: datetime.strptime(name, TIME_FORMAT) for name in sources}
+    if not times:
+        return []
+    origin = origin or min(times.values())
+    deliveries = []
+    for name, t in sorted(times.items()):
+        if in_windows(t, gaps) is not None:
+            continue
+        arrive = in_windows(t, outages) or t
+        at = (arrive - origin).total_seconds() / speed if speed else 0.0
+        deliveries.append(
+            Delivery(at, name, sources[name], Path(dest),
+                     None if png is None else Path(png),
+                     rng.random() < partial))
+    return deliveries
+
+
+def process_tree(pid: int) -> List[int]:
+    """pidとその子孫のプロセスID"""
+    children: Dict[int, List[int]] = {}
+    for stat in Path('/proc').glob('[0-9]*/stat'):
+        try:
+            fields = stat.read_text().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(stat.parent.name))
+    tree, stack = [], [pid]
+    while stack:
+        p = stack.pop()
+        tree.append(p)
+        stack.extend(children.get(p, []))
+    return tree
+
+
+def usage(pid: int) -> tuple[float, float]:
+    """pidと子孫のプロセスの(CPU時間[sec], メモリ使用量[MB])
+    終了して回収された子プロセスのCPU時間も含む
+    """
+    cpu = rss = 0.0
+    for p in process_tree(pid):
+        try:
+            fields = Path(f'/proc/{p}/stat').read_text().rsplit(')',
+                                                                 1)[1].split()
+            pages = int(Path(f'/proc/{p}/statm').read_text().split()[1])
+        except OSError:  # 計測中に終了した
+            continue
+        # utime, stime, cutime, cstime
+        cpu += sum(int(x) for x in fields[11:15]) / CLOCK_TICKS
+        rss += pages * PAGE_SIZE / 1024**2
+    return cpu, rss
+
+
+class Recorder:
+    """配送したファイルのpngができるまでの遅延と、監視ツールの負荷を記録する"""
+
+    def __init__(self, pid: Optional[int] = None, interval: float = 1):
+        """
+        pid: 計測する監視ツールのプロセスID。NoneでCPU使用率とメモリ使用量を計測しない
+        interval: 計測間隔(sec)
+        """
+        self.pid = pid
+        self.interval = interval
+        self.start = time()
+        self.delivered: Dict[str, tuple] = {}  # {txtディレクトリ}/{ファイル名}: (配送時刻, Delivery)
+        self.latency: Dict[str, float] = {}
+        self.samples: List[dict] = []
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._cpu = usage(pid)[0] if pid else 0.0
+        self._last = time()
+
+    def deliver(self, delivery: Delivery):
+        """配送した時刻を記録する"""
+        with self._lock:
+            self.delivered[f'{delivery.dest}/{delivery.name}'] = (time(),
+                                                                  delivery)
+
+    @property
+    def backlog(self) -> int:
+        """pngがまだないファイル数"""
+        with self._lock:
+            return sum(1 for key, (_, d) in self.delivered.items()
+                       if d.png is not None and key not in self.latency)
+
+    def sample(self):
+        """pngができたファイルの遅延と、未処理数、CPU使用率、メモリ使用量を記録する"""
+        with self._lock:
+            now = time()
+            for key, (t, d) in self.delivered.items():
+                if d.png is None or key in self.latency:
+                    continue
+                try:
+                    mtime = os.stat(d.png / f'{d.name}.png').st_mtime
+                except FileNotFoundError:
+                    continue
+                self.latency[key] = max(mtime - t, 0.0)
+            row = {
+                'elapsed': now - self.start,
+                'delivered': len(self.delivered),
+                'backlog': self.backlog,
+            }
+            if self.pid:
+                cpu, rss = usage(self.pid)
+                row['cpu'] = 100 * (cpu - self._cpu) / max(now - self._last,
+                                                           1e-9)
+                row['rss'] = rss
+                self._cpu, self._last = cpu, now
+            self.samples.append(row)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+    def summary(self) -> dict:
+        """遅延(p50, p95, 最大)、最大未処理数、平均CPU使用率、最大メモリ使用量"""
+        latency = np.array(list(self.latency.values()))
+        samples = pd.DataFrame(self.samples)
+        result = {
+            'delivered': len(self.delivered),
+            'rendered': len(latency),
+            'latency_p50': np.percentile(latency, 50) if latency.size else None,
+            'latency_p95': np.percentile(latency, 95) if latency.size else None,
+            'latency_max': latency.max() if latency.size else None,
+            'backlog_max': samples['backlog'].max() if len(samples) else 0,
+        }
+        if 'cpu' in samples:
+            result['cpu_mean'] = samples['cpu'].mean()
+            result['rss_max'] = samples['rss'].max()
+        return result
+
+
+def deliver(delivery: Delivery, ingest: Optional[str] = None,
+            partial_delay: float = 5):
+    """1ファイルを届ける
+    ingestを指定したときはIngestServerに送る
+    .gz, .zstのファイルは展開して{name}.txtとして置く
+    partialのときは半分だけ書き、partial_delay秒後に別スレッドで残りを書く
+    最終更新時刻は配送した時刻になる(監視ツールが到着時刻として学習する)
+    """
+    if ingest is not None:
+        reply = send(ingest, delivery.src)[0]
+        if not reply.startswith('OK'):
+            print(f'{delivery.name}: {reply}')
+        return
+    dest = delivery.dest / f'{delivery.name}.txt'
+    with open_trace(delivery.src) as f:  # 圧縮ファイルは展開して置く
+        body = f.read().encode('utf-8')
+    if not delivery.partial:
+        dest.write_bytes(body)
+        return
+    with open(dest, 'wb') as f:
+        f.write(body[:len(body) // 2])
+
+    def rest():
+        with open(dest, 'ab') as f:
+            f.write(body[len(body) // 2:])
+
+    threading.Timer(partial_delay, rest).start()
+
+
+def replay(deliveries: List[Delivery],
+           recorder: Recorder,
+           ingest: Optional[str] = None,
+           partial_delay: float = 5,
+           drain: float = 60):
+    """deliveriesを予定の時刻に届け、
+    最後のpngができるか、最後の配送からdrain秒経つまで計測する
+    """
+    with recorder:
+        start = time()
+        for delivery in sorted(deliveries, key=lambda d: d.at):
+            wait = start + delivery.at - time()
+            if wait > 0:
+                sleep(wait)
+            deliver(delivery, ingest, partial_delay)
+            recorder.deliver(delivery)
+        deadline = time() + drain
+        while time() < deadline and recorder.backlog > 0:
+            sleep(recorder.interval)
+
+
+def parse_window(values: List[str]) -> tuple:
+    """['%Y%m%d_%H%M%S', 秒数]を(開始, 秒数)にする"""
+    return datetime.strptime(values[0], TIME_FORMAT), float(values[1])
+
+
+def main():
+    """entry point"""
+    parser = argparse.ArgumentParser(description='保存済みのtxtファイルを再生して監視ツールを計測します')
+    parser.add_argument('-i',
+                        '--instrument',
+                        help='測定器ごとの保存済みのtxtディレクトリ、置き直すtxtディレクトリ、'
+                        'pngディレクトリ(-で遅延を計測しない)。複数指定可能',
+                        nargs=3,
+                        action='append',
+                        metavar=('ARCHIVE', 'DEST', 'PNG'),
+                        required=True)
+    parser.add_argument('--glob', help='保存済みのtxtファイルのglobパターン', default='*')
+    parser.add_argument('--speed',
+                        help='再生速度(実時間の何倍か)。0で待たずに届ける',
+                        type=float,
+                        default=60)
+    parser.add_argument('--outage',
+                        help='開始時刻(%%Y%%m%%d_%%H%%M%%S)から秒数の間止めて、終わりにまとめて届ける。複数指定可能',
+                        nargs=2,
+                        action='append',
+                        default=[],
+                        metavar=('START', 'SECONDS'))
+    parser.add_argument('--gap',
+                        help='開始時刻(%%Y%%m%%d_%%H%%M%%S)から秒数の間のファイルを届けない。複数指定可能',
+                        nargs=2,
+                        action='append',
+                        default=[],
+                        metavar=('START', 'SECONDS'))
+    parser.add_argument('--partial',
+                        help='書き込み途中の状態を作るファイルの割合',
+                        type=float,
+                        default=0)
+    parser.add_argument('--partial-delay',
+                        help='書き込み途中のファイルの残りを書くまでの時間(sec)',
+                        type=float,
+                        default=5)
+    parser.add_argument('--ingest', help='txtディレクトリに置く代わりに送るIngestServerのアドレス')
+    parser.add_argument('--seed', help='--partialの乱数のシード', type=int)
+    parser.add_argument('--pid', help='計測する監視ツールのプロセスID', type=int)
+    parser.add_argument('--command', help='監視ツールを起動するコマンド。終了時にSIGINTで止める')
+    parser.add_argument('--interval', help='計測間隔(sec)', type=float, default=1)
+    parser.add_argument('--drain',
+                        help='最後の配送後に未処理のファイルを待つ時間(sec)',
+                        type=float,
+                        default=60)
+    parser.add_argument('--output', help='計測結果を保存するcsvファイル')
+    args = parser.parse_args()
+
+    outages = [parse_window(w) for w in args.outage]
+    gaps = [parse_window(w) for w in args.gap]
+    rng = random.Random(args.seed)
+    instruments = []
+    for archive, dest, png in args.instrument:
+        Path(dest).mkdir(parents=True, exist_ok=True)
+        sources = find_traces(str(Path(archive) / args.glob))
+        instruments.append((sources, dest, None if png == '-' else png))
+    # 全測定器で同じ時刻を再生開始時刻にする
+    origin = min(
+        (datetime.strptime(name, TIME_FORMAT)
+         for sources, _, _ in instruments for name in sources),
+        default=None)
+    deliveries = []
+    for sources, dest, png in instruments:
+        deliveries += schedule(sources, dest, png, args.speed, origin, outages,
+                               gaps, args.partial, rng)
+    print(f'replay {len(deliveries)} files, '
+          f'{max((d.at for d in deliveries), default=0):.0f} sec')
+
+    process = None
+    pid = args.pid
+    if args.command:
+        process = subprocess.Popen(shlex.split(args.command))
+        pid = process.pid
+    recorder = Recorder(pid, args.interval)
+    try:
+        replay(deliveries, recorder, args.ingest, args.partial_delay,
+               args.drain)
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGINT)
+            process.wait()
+    if args.output:
+        pd.DataFrame(recorder.samples).to_csv(args.output, index=False)
+        latency = pd.Series(recorder.latency, name='latency')
+        latency.to_csv(Path(args.output).with_suffix('.latency.csv'),
+                       index_label='file')
+    for key, value in recorder.summary().items():
+        print(f'{key}: {value}')
+
+
+if __name__ == '__main__':
+    main()
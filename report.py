@@ -1,7 +1,28 @@
 #!/usr/bin/env python3
-"""時系列ファイルのサマリーカウント"""
+"""時系列ファイルのサマリーカウントとマーカー統計のレポート
+
+マーカー統計は1スイープ読み込むたびにマーカーごとの統計値を
+`markers_{yyyymmdd}.csv`に1行ずつ追記しておき、
+レポート(watchdog_SN.xlsx)はtxtファイルを読み直さずにそこから作る。
+
+USAGE:
+    # 期間を指定してマーカー統計からS/N比レポートを作成
+    $ python report.py -d stats/markers --start 20151101 --end 20151130 \
+        watchdog_SN.xlsx
+"""
+import argparse
+import glob
 from collections import Counter
+from pathlib import Path
+from typing import Dict, Optional
+import numpy as np
+import pandas as pd
 import yaml
+from SAtraceWatchdog.lease import atomic_path
+
+# マーカー周波数の前後の帯域幅(index単位)。±0.2kHz
+BAND_SPAN = 0.4
+STATS_COLUMNS = ['time', 'marker', 'freq', 'power', 'sn', 'band']
 
 
 def timestamp_count(timestamps, filename):
@@ -18,11 +39,143 @@ def timestamp_count(timestamps, filename):
     Counter({'20200406': 24, '20200407': 24, '20200408': 24, '20200409': 24, '20200410': 4})
     """
     count = Counter(timestamps)
-    with open(filename, 'w') as _f:
+    with atomic_path(filename) as tmp, open(tmp, 'w') as _f:
         yaml.dump(dict(count), _f)
     return count
 
 
+def marker_stats(trs: pd.Series,
+                 markers: list[float],
+                 span: float = BAND_SPAN) -> pd.DataFrame:
+    """1スイープ(index: 周波数)のマーカーごとの統計値
+    * freq: マーカーに最も近い周波数
+    * power: freqの受信電力(dB)
+    * sn: freqのS/N比(dB) ノイズフロアはTrace.noisefloor()と同じ1/4 quantile
+    * band: マーカー±span/2の平均電力(dB)
+
+    >>> trs = pd.Series([-100, -100, -70, -100, -100.0],
+    ...                 index=[22.0, 22.1, 22.2, 22.3, 22.4])
+    >>> marker_stats(trs, [22.2], span=0.0)
+       marker  freq  power    sn  band
+    0    22.2  22.2  -70.0  30.0 -70.0
+    """
+    index = trs.index.to_numpy(dtype=float)
+    values = trs.to_numpy(dtype=float)
+    floor = np.nanquantile(values, 0.25)
+    rows = []
+    for marker in markers:
+        i = np.argmin(np.abs(index - marker))
+        band = values[(index >= marker - span / 2) & (index <= marker + span / 2)]
+        with np.errstate(divide='ignore'):
+            band_db = 10 * np.log10(np.nanmean(10**(band / 10))) if band.size \
+                else np.nan
+        rows.append((marker, index[i], values[i], values[i] - floor, band_db))
+    return pd.DataFrame(rows, columns=STATS_COLUMNS[1:])
+
+
+def stats_filename(directory, day: str) -> Path:
+    """dayのマーカー統計を追記するファイル"""
+    return Path(directory) / f'markers_{day}.csv'
+
+
+def append_marker_stats(filename, timestamp, stats: pd.DataFrame):
+    """1スイープ分のmarker_stats()の結果にtimeをつけてfilenameに追記する"""
+    stats = stats.assign(time=pd.Timestamp(timestamp))[STATS_COLUMNS]
+    exists = Path(filename).exists()
+    stats.to_csv(filename,
+                 mode='a',
+                 header=not exists,
+                 index=False,
+                 date_format='%Y-%m-%d %H:%M:%S')
+
+
+def stats_timestamps(filename) -> pd.DatetimeIndex:
+    """filenameに追記済みの時刻"""
+    times = pd.read_csv(filename, usecols=['time'], parse_dates=['time'])
+    return pd.DatetimeIndex(times['time'].unique())
+
+
+def load_marker_stats(directory,
+                      start: Optional[str] = None,
+                      end: Optional[str] = None) -> pd.DataFrame:
+    """directoryのmarkers_{yyyymmdd}.csvのうちstart~end(yyyymmdd, 両端含む)を
+    1つのDataFrameにまとめる
+    """
+    frames = []
+    for f in sorted(glob.glob(str(Path(directory) / 'markers_*.csv'))):
+        day = Path(f).stem[len('markers_'):]
+        if (start and day < start) or (end and day > end):
+            continue
+        frames.append(pd.read_csv(f, parse_dates=['time']))
+    if not frames:
+        return pd.DataFrame(columns=STATS_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def sn_report(stats: pd.DataFrame,
+              freq: Optional[str] = None,
+              threshold: float = 10,
+              percentile: float = 0.95) -> Dict[str, pd.DataFrame]:
+    """マーカー統計からレポートの表を作る
+    * band: 行が時刻、列がマーカーの±span/2の平均電力(dB)
+            freqを指定したときはfreqごとに平均する
+    * SN: 日付とマーカーごとのTrace.describe_SN()と同じ統計値
+    """
+    stats = stats.assign(day=stats['time'].dt.strftime('%Y%m%d'),
+                         mw=10**(stats['band'] / 10))
+    time = stats['time'] if freq is None else stats['time'].dt.floor(freq)
+    with np.errstate(divide='ignore'):
+        band = 10 * np.log10(
+            stats.pivot_table(index=time,
+                              columns='marker',
+                              values='mw',
+                              aggfunc='mean'))
+    group = stats.groupby(['day', 'marker'])
+    count = (stats['sn'] >= threshold).groupby([stats['day'],
+                                                stats['marker']]).sum()
+    total = group['sn'].count()
+    sn = pd.DataFrame({
+        'ターゲット周波数': group['freq'].first(),
+        '受信電力': group['power'].quantile(percentile),
+        'SN比': group['sn'].quantile(percentile),
+        'ターゲット受信回数': count,
+        '全受信回数': total,
+        '受信割合': count / total,
+    })
+    return {'band': band, 'SN': sn}
+
+
+def write_report(filename, sheets: Dict[str, pd.DataFrame]):
+    """sheetsをxlsxの各シートに書き出す
+    拡張子が.csvのときは{ファイル名}_{シート名}.csvに書き出す
+    """
+    filename = Path(filename)
+    if filename.suffix == '.csv':
+        for name, df in sheets.items():
+            with atomic_path(
+                    filename.with_name(f'{filename.stem}_{name}.csv')) as tmp:
+                df.to_csv(tmp)
+        return
+    with atomic_path(filename) as tmp, pd.ExcelWriter(tmp) as writer:
+        for name, df in sheets.items():
+            df.to_excel(writer, sheet_name=name)
+
+
+def main():
+    """entry point"""
+    parser = argparse.ArgumentParser(description='マーカー統計からS/N比レポートを作成します')
+    parser.add_argument('output', help='出力ファイル名(.xlsx or .csv)')
+    parser.add_argument('-d', '--directory', help='マーカー統計のディレクトリ',
+                        default='.')
+    parser.add_argument('--start', help='開始日 yyyymmdd')
+    parser.add_argument('--end', help='終了日 yyyymmdd')
+    parser.add_argument('-f',
+                        '--freq',
+                        help='band表を平均する時間幅(1h, 1d, ...) 指定しなければスイープごと')
+    args = parser.parse_args()
+    stats = load_marker_stats(args.directory, args.start, args.end)
+    write_report(args.output, sn_report(stats, freq=args.freq))
+
+
 if __name__ == '__main__':
-    import doctest
-    doctest.testmod()
+    main()
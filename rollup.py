@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""日ごとのロールアップと長期ウォーターフォール
+
+1日分のTrace(index: 周波数, columns: datetime)を
+粗い時間幅(30min, 1hなど)ごとの max / mean / min に縮約して
+`rollup_{yyyymmdd}.npz` として保存する。
+週単位、月単位のウォーターフォールは
+テキストファイルを読み直さずにロールアップだけから描画する。
+
+USAGE:
+    # 1日分のtxtファイルからロールアップを作成
+    $ python rollup.py build -o stats/rollup 20151111_*.txt
+    # ロールアップから期間を指定してウォーターフォールを描画
+    $ python rollup.py plot -o stats/rollup --start 20151101 --end 20151130 \
+        waterfall_201511.png
+"""
+import argparse
+import glob
+from pathlib import Path
+from typing import Dict, Optional
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from SAtraceWatchdog.tracer import Trace, read_traces, fine_ticks, seaborn_option
+
+STATS = ('max', 'mean', 'min')
+
+
+def make_rollup(trss: Trace, freq: str = '1h') -> Dict[str, Trace]:
+    """1日分のTraceをfreqの時間幅ごとに縮約して
+    {'max': Trace, 'mean': Trace, 'min': Trace}で返す。
+
+    meanはdBのままではなく電力(mW)で平均してからdBに戻す。
+
+    >>> idx = pd.date_range('2015-11-11', freq='30min', periods=4)
+    >>> trss = Trace([[-100.0, -90.0, -80.0, -80.0]], index=[22.2], columns=idx)
+    >>> roll = make_rollup(trss, '1h')
+    >>> roll['max'].values.tolist()
+    [[-90.0, -80.0]]
+    >>> roll['min'].values.tolist()
+    [[-100.0, -80.0]]
+    """
+    resampler = trss.T.resample(freq)
+    return {
+        'max': Trace(resampler.max().T),
+        'mean': Trace(trss.db2mw().T.resample(freq).mean().T.mw2db()),
+        'min': Trace(resampler.min().T),
+    }
+
+
+def rollup_filename(directory, yyyymmdd: str) -> Path:
+    """ロールアップファイル名"""
+    return Path(directory) / f'rollup_{yyyymmdd}.npz'
+
+
+def save_rollup(filename, rollup: Dict[str, Trace]):
+    """ロールアップをfloat32の圧縮npzで保存する"""
+    base = rollup['max']
+    np.savez_compressed(
+        filename,
+        freqs=base.index.to_numpy(dtype=float),
+        unit=np.array(str(base.index.name)),
+        times=base.columns.to_numpy(dtype='datetime64[ns]'),
+        **{k: rollup[k].to_numpy(dtype=np.float32)
+           for k in STATS},
+    )
+
+
+def load_rollup(filename) -> Dict[str, Trace]:
+    """save_rollup()で保存したファイルを読み込む"""
+    with np.load(filename) as npz:
+        index = pd.Index(npz['freqs'], name=str(npz['unit']))
+        columns = pd.DatetimeIndex(npz['times'])
+        return {
+            k: Trace(npz[k].astype(float), index=index, columns=columns)
+            for k in STATS
+        }
+
+
+def load_rollups(directory,
+                 start: Optional[str] = None,
+                 end: Optional[str] = None) -> Dict[str, Trace]:
+    """directory内のstartからendまで(yyyymmdd, 両端含む)の
+    ロールアップを時間方向に連結して返す
+    """
+    files = []
+    for f in sorted(glob.glob(f'{directory}/rollup_*.npz')):
+        day = Path(f).stem[len('rollup_'):]
+        if start is not None and day < start:
+            continue
+        if end is not None and day > end:
+            continue
+        files.append(f)
+    if not files:
+        raise FileNotFoundError(f'{directory} にロールアップがありません')
+    rollups = [load_rollup(f) for f in files]
+    return {
+        k: Trace(pd.concat([r[k] for r in rollups], axis=1))
+        for k in STATS
+    }
+
+
+def plot_longterm(
+    rollup: Dict[str, Trace],
+    stat: str = 'max',
+    title: str = '',
+    xlabel: str = 'Frequency[kHz]',
+    figsize=(8, 12),
+    cmap='viridis',
+    cmaphigh: float = -60.0,
+    cmaplow: float = -100.0,
+    cmapstep: int = 10,
+    extend='both',
+):
+    """ロールアップから複数日のウォーターフォールを描画する
+    欠けている時間帯は空白になるように時間軸を等間隔に詰め直す。
+    """
+    seaborn_option()
+    trss = rollup[stat]
+    times = trss.columns
+    if len(times) > 1:
+        # ロールアップの時間幅は時刻の最小間隔とする
+        grid = pd.date_range(times.min().normalize(),
+                             times.max().normalize() + pd.Timedelta('1D'),
+                             freq=pd.Timedelta(np.diff(times).min()),
+                             inclusive='left')
+        trss = trss.reindex(columns=grid)
+    dfk = trss.T
+
+    fig, ax = plt.subplots(figsize=figsize)
+    mesh = ax.pcolormesh(dfk.columns.values,
+                         np.arange(len(dfk)),
+                         dfk.values,
+                         vmin=cmaplow,
+                         vmax=cmaphigh,
+                         cmap=cmap,
+                         shading='nearest',
+                         rasterized=True)
+    # 範囲外は白抜き
+    mesh.cmap.set_over('white')
+    mesh.cmap.set_under('white')
+    # 日付の変わり目にラベル
+    days = np.flatnonzero(dfk.index.normalize() == dfk.index)
+    step = max(1, len(days) // 15)
+    ax.set_yticks(days[::step])
+    ax.set_yticklabels(dfk.index[days[::step]].strftime('%m/%d'))
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(title)
+    fig.colorbar(mesh,
+                 ticks=fine_ticks(np.array([cmaplow, cmaphigh]), cmapstep),
+                 extend=extend)
+    return ax
+
+
+def main():
+    """entry point"""
+    parser = argparse.ArgumentParser(description='日ごとのロールアップの作成と長期ウォーターフォールの描画')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help='1日分のtxtファイルからロールアップを作成')
+    build.add_argument('files', help='1日分のtxtファイル', nargs='+')
+    build.add_argument('-o', '--directory', help='ロールアップ保存ディレクトリ',
+                       default='.')
+    build.add_argument('-c', '--column', help='ロールアップする列指定',
+                       default='AVER')
+    build.add_argument('-f', '--freq', help='ロールアップの時間幅', default='1h')
+    plot = sub.add_parser('plot', help='ロールアップから長期ウォーターフォールを描画')
+    plot.add_argument('output', help='出力画像ファイル名')
+    plot.add_argument('-o', '--directory', help='ロールアップ保存ディレクトリ',
+                      default='.')
+    plot.add_argument('--start', help='開始日 yyyymmdd')
+    plot.add_argument('--end', help='終了日 yyyymmdd')
+    plot.add_argument('--stat', choices=STATS, default='max')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        days = {Path(f).stem[:8] for f in args.files}
+        for day in sorted(days):
+            files = [f for f in args.files if Path(f).stem.startswith(day)]
+            trss = read_traces(*files, usecols=args.column)
+            save_rollup(rollup_filename(args.directory, day),
+                        make_rollup(trss, args.freq))
+    else:
+        rollup = load_rollups(args.directory, args.start, args.end)
+        plot_longterm(rollup, stat=args.stat, title=args.stat)
+        plt.savefig(args.output)
+        plt.close()
+
+
+if __name__ == '__main__':
+    main()
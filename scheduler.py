@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""到着時刻を予測するポーリング間隔の決定
+
+txtファイルはおよそrate秒ごとに届くので、過去のファイルの到着時刻(mtime)から
+到着の位相(到着時刻 mod rate)とそのばらつきを学習し、
+次の到着予定時刻の前後(window)だけ短い間隔でポーリングする。
+それ以外は次のwindowの始まりまで待つ。
+
+* 学習前(到着が2件未満) -> fallback秒
+* 次の到着予定の前 -> windowの始まりまで(最大rate秒)
+* window内 -> poll_min秒
+* windowを過ぎても届かない(遅延) -> fallback秒
+
+USAGE:
+    scheduler = ArrivalScheduler(rate=300)
+    scheduler.observe(os.stat(f).st_mtime for f in new_files)
+    sleep(scheduler.next_delay(time(), fallback=check_rate))
+"""
+import math
+from collections import deque
+from typing import Iterable, Optional
+
+
+class ArrivalScheduler:
+    """到着時刻の位相を学習して次のポーリングまでの秒数を返す
+
+    >>> s = ArrivalScheduler(rate=300, window_min=5)
+    >>> s.observe([1000.0, 1301.0, 1599.0])
+    >>> round(s.phase)
+    100
+    >>> s.next_delay(1610, fallback=10)  # 次の到着予定1900の5秒前まで待つ
+    285.0
+    >>> s.next_delay(1897, fallback=10)  # window内
+    1
+    >>> s.next_delay(1920, fallback=10)  # 遅延
+    10
+    """
+
+    def __init__(self,
+                 rate: float,
+                 poll_min: float = 1,
+                 window_min: float = 5,
+                 history: int = 32):
+        """
+        rate: ファイルの送信間隔(sec)
+        poll_min: window内のポーリング間隔(sec)
+        window_min: 到着予定時刻の前後に短い間隔でポーリングする最小の幅(sec)
+        history: 位相の学習に使う到着時刻の数
+        """
+        self.rate = rate
+        self.poll_min = poll_min
+        self.window_min = window_min
+        self.arrivals: deque = deque(maxlen=history)
+
+    def observe(self, mtimes: Iterable[float]):
+        """届いたファイルの到着時刻(mtime)を記録する"""
+        for mtime in sorted(mtimes):
+            self.arrivals.append(float(mtime))
+
+    @property
+    def phase(self) -> Optional[float]:
+        """到着時刻 mod rate の円周平均(sec)。学習前はNone"""
+        if len(self.arrivals) < 2:
+            return None
+        angles = [2 * math.pi * (t % self.rate) / self.rate for t in self.arrivals]
+        x = sum(math.cos(a) for a in angles)
+        y = sum(math.sin(a) for a in angles)
+        return (math.atan2(y, x) % (2 * math.pi)) * self.rate / (2 * math.pi)
+
+    @property
+    def window(self) -> float:
+        """到着予定時刻の前後にポーリングする幅(sec)
+        位相のばらつき(標準偏差)の3倍、window_min以上rate/2以下
+        """
+        phase = self.phase
+        if phase is None:
+            return self.window_min
+        # 位相からのずれを -rate/2 ~ rate/2 にする
+        dev = [((t - phase + self.rate / 2) % self.rate) - self.rate / 2
+               for t in self.arrivals]
+        std = math.sqrt(sum(d * d for d in dev) / len(dev))
+        return min(max(3 * std, self.window_min), self.rate / 2)
+
+    def expected(self) -> Optional[float]:
+        """最後の到着の次の到着予定時刻。学習前はNone"""
+        phase = self.phase
+        if phase is None:
+            return None
+        last = self.arrivals[-1]
+        # lastからrate/2以上先で、位相がphaseになる最初の時刻
+        base = last + self.rate / 2
+        return base + (phase - base) % self.rate
+
+    def next_delay(self, now: float, fallback: float) -> float:
+        """nowから次にポーリングするまでの秒数"""
+        expected = self.expected()
+        if expected is None:
+            return fallback
+        window = self.window
+        if now < expected - window:
+            return min(expected - window - now, self.rate)
+        if now <= expected + window:
+            return self.poll_min
+        return fallback
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""ウォーターフォールのタイルピラミッド出力
+
+1日分のデータ(縦: 時刻, 横: 周波数)を1ピクセル=1データ点の画像として、
+tile x tile ピクセルのタイルに分けて複数のズームレベルで保存する。
+ズームレベルを1つ下げるごとに縦横1/2に縮小する。
+縮小は最大値で行うので、狭帯域の信号も消えない。
+
+出力:
+    {directory}/tiles.json        ピラミッドの情報と描画済みの時刻行
+    {directory}/{z}/{x}_{y}.png   ズームレベルz, 横x番目, 縦y番目のタイル
+                                  z=0が最も縮小したレベル、縦は上が00:00
+
+新しい時刻行が届いたときは、その行を含むタイルだけを描き直す。
+"""
+import json
+import math
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+from SAtraceWatchdog.tracer import day_grid
+from SAtraceWatchdog.lease import atomic_path
+
+
+def num_levels(shape: tuple, tile: int) -> int:
+    """最も縮小したレベルが1タイルに収まるズームレベル数-1"""
+    return max(0, math.ceil(math.log2(max(shape) / tile)))
+
+
+def pool_max(block: np.ndarray, factor: int) -> np.ndarray:
+    """factor x factor ピクセルごとの最大値(NaNは無視)に縮小する
+
+    >>> pool_max(np.arange(16.0).reshape(4, 4), 2)
+    array([[ 5.,  7.],
+           [13., 15.]])
+    """
+    if factor == 1:
+        return block
+    h = -(-block.shape[0] // factor)
+    w = -(-block.shape[1] // factor)
+    padded = np.full((h * factor, w * factor), np.nan, dtype=block.dtype)
+    padded[:block.shape[0], :block.shape[1]] = block
+    return np.fmax.reduce(np.fmax.reduce(padded.reshape(h, factor, w, factor),
+                                         axis=3),
+                          axis=1)
+
+
+def update_tiles(
+    directory,
+    day: str,
+    trss: pd.DataFrame,
+    rate: int = 300,
+    cmap='viridis',
+    cmaphigh: float = -60.0,
+    cmaplow: float = -100.0,
+    tile: int = 256,
+) -> int:
+    """dayのタイルピラミッドをdirectoryに出力し、描画したタイル数を返す
+    前回から増えた時刻行を含むタイルだけを描き直す。
+    範囲外の値は白、データのないところは透明にする。
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    grid = day_grid(trss, day, rate)
+    height, width = grid.shape
+    nlevels = num_levels(grid.shape, tile)
+    meta = {
+        'day': day,
+        'rate': rate,
+        'width': width,
+        'height': height,
+        'tile': tile,
+        'levels': nlevels + 1,
+        'freq_start': float(trss.index[0]),
+        'freq_stop': float(trss.index[-1]),
+        'unit': str(trss.index.name),
+        'cmap': cmap,
+        'cmaplow': cmaplow,
+        'cmaphigh': cmaphigh,
+    }
+    filled = set(np.flatnonzero(~np.isnan(grid).all(axis=1)).tolist())
+    meta_file = directory / 'tiles.json'
+    done = set()
+    if meta_file.exists():
+        with open(meta_file) as f:
+            last = json.load(f)
+        # ピラミッドの形か色の設定が変わったら全部描き直す
+        if {k: last.get(k) for k in meta} == meta:
+            done = set(last['rows'])
+    changed = filled - done
+
+    colormap = mpl.colormaps[cmap].copy()
+    colormap.set_over('white')
+    colormap.set_under('white')
+    colormap.set_bad(alpha=0)
+    norm = mpl.colors.Normalize(vmin=cmaplow, vmax=cmaphigh)
+    count = 0
+    for z in range(nlevels + 1):
+        factor = 2**(nlevels - z)
+        span = tile * factor  # 1タイルが覆う元データのピクセル数
+        (directory / str(z)).mkdir(exist_ok=True)
+        for y in sorted({r // span for r in changed}):
+            for x in range(-(-width // span)):
+                block = grid[y * span:(y + 1) * span, x * span:(x + 1) * span]
+                image = pool_max(block, factor)
+                rgba = colormap(norm(np.ma.masked_invalid(image)))
+                with atomic_path(directory / str(z) / f'{x}_{y}.png') as tmp:
+                    plt.imsave(tmp, rgba)
+                count += 1
+    meta['rows'] = sorted(filled)
+    with atomic_path(meta_file) as tmp, open(tmp, 'w') as f:
+        json.dump(meta, f)
+    return count
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
 """SAtraceを扱いやすくするクラス Trace()"""
+import contextlib
 import datetime
+import glob
+import gzip
+import io
+import itertools
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 from types import SimpleNamespace
@@ -13,6 +20,10 @@ from matplotlib.pylab import yticks
 from tqdm import tqdm
 import pandas as pd
 
+DAY_SECOND = 60 * 60 * 24
+# 読み込めるテキストファイルの拡張子(.gz, .zstは展開しながら読む)
+TRACE_SUFFIXES = ('.txt', '.txt.gz', '.txt.zst')
+
 
 def seaborn_option():
     sns.set(
@@ -68,7 +79,7 @@ def read_conf(line: str) -> dict:
 
 def title_renamer(filename: str) -> str:
     """ファイル名から %Y/%m/%d %T 形式の日付を返す"""
-    basename = Path(filename).stem
+    basename = trace_stem(filename)
     n = str(basename).replace('_', '')
     #  return like %Y%m%d %H:%M%S
     return f'{n[:4]}/{n[4:6]}/{n[6:8]} {n[8:10]}:{n[10:12]}:{n[12:14]}'
@@ -176,6 +187,44 @@ class Trace(pd.DataFrame):
         df = self.loc[start:stop]
         return df.db2mw().sum()
 
+    def decimate(self, width: int):
+        """周波数方向をwidth区間に分け、区間ごとのmin/maxの包絡線に間引いて返す
+        ピクセル幅より多い点数を描画しても見た目は変わらないので、
+        描画とsavefigの時間を減らすために使う。
+        区間ごとにmin, maxの2点を残すので、ピークは失われない。
+        行数が2*width以下のときは間引かずにそのまま返す。
+
+        >>> trs = Trace(np.arange(10.0), index=np.arange(10.0))
+        >>> trs.decimate(2).squeeze().tolist()
+        [0.0, 4.0, 5.0, 9.0]
+        >>> trs.decimate(5).shape
+        (10, 1)
+        """
+        n = len(self)
+        if width < 1 or n <= 2 * width:
+            return self
+        k = -(-n // width)  # 1区間あたりの点数(切り上げ)
+        nb = -(-n // k)  # 区間数
+        pad = nb * k - n
+        values = self.to_numpy(dtype=float)
+        values = np.pad(values, ((0, pad), (0, 0)), constant_values=np.nan)
+        blocks = values.reshape(nb, k, -1)
+        # fmin/fmaxはNaNを無視する(全てNaNならNaN)
+        envelope = np.empty((nb * 2, blocks.shape[-1]))
+        envelope[0::2] = np.fmin.reduce(blocks, axis=1)
+        envelope[1::2] = np.fmax.reduce(blocks, axis=1)
+        # 区間の最初と最後の周波数をmin/maxのindexとする
+        index = self.index.to_numpy()
+        starts = index[::k]
+        stops = index[np.minimum(np.arange(1, nb + 1) * k, n) - 1]
+        new_index = np.empty(nb * 2, dtype=index.dtype)
+        new_index[0::2] = starts
+        new_index[1::2] = stops
+        df = pd.DataFrame(envelope,
+                          index=pd.Index(new_index, name=self.index.name),
+                          columns=self.columns)
+        return Trace(df)
+
     def describe_SN(self, tgt_freq: float, percentile=0.95):
         """ 特定周波数の統計値を求める。
         @params
@@ -224,38 +273,56 @@ class Trace(pd.DataFrame):
         cmapstep: int = 10,
         extend='both',
         dpi=100,
+        rate: int = 300,
+        reduce: str = 'max',
     ):
         """スペクトラムプロット / ウォータフォール
         引数:
             self: Trace(pd.DataFrame)
-                * index: datetime
-                * columns: frequency(float type)
+                * index: frequency(float type)
+                * columns: datetime
             title: string(ウォータフォールのylabelの位置につく)
+            rate: スイープ間隔(sec)
+            reduce: 行を縮約するときの方法 'max' or 'mean'
         戻り値: なし(上にスペクトラムプロット、下にウォータフォール)
 
         * 全プロットを重ねてラインプロット
+            * 点数が画像の横ピクセル数を超えるときはmin/maxの包絡線に間引く
         * 注目周波数だけを赤色のマーカーでマーカープロット
-        * 一日5分間隔で測定されたデータを整形する(resample, reindexメソッド)
+        * 一日rate秒間隔で測定されたデータを 時刻 x 周波数 の配列に整形する
+            * 行数がウォーターフォールの縦のピクセル数を超えるときは
+              表示する1行ごとにreduceで縮約する
         * ウォータフォールをイメージプロット(countourf plot)"""
         # local const
-        FREQ = '5min'
-        PERIODS = 288
         G = gs.GridSpec(3, 14)
+        periods = DAY_SECOND // rate  # 1日の行数 5分間隔なら288
+        # ウォーターフォールの縦のピクセル数(グラフ3段のうち下2段)
+        height = int(figsize[1] * dpi * 2 / 3)
+        # 縦のピクセル数より行が多いときはfactor行ごとに縮約する
+        factor = max(1, -(-periods // height))
 
         seaborn_option()
 
+        # __MAKE WATERFALL DATA________________
+        # 1日をrate秒ごとに区切った 時刻 x 周波数 の配列(隙間と最初/最後はNaN)
+        grid = reduce_rows(day_grid(self, title, rate), factor, how=reduce)
+
         # __ALLPLOT___________________
         ax1 = plt.subplot(G[0, :-1])
         # Spectrum plot
         ylim = (
             ylim[0] * 0.99,  # 1% loss for graph ytick line
             ylim[1])
-        ax = self.plot(legend=False,
-                       color=color,
-                       linewidth=linewidth,
-                       ylim=ylim,
-                       figsize=figsize,
-                       ax=ax1)
+        # スイープ数が縦のピクセル数より多いときは縮約した行を重ねる
+        overlay = self if factor == 1 else Trace(
+            pd.DataFrame(grid.T, index=self.index).dropna(axis=1, how='all'))
+        # 横ピクセル数より多い点は描画しても見えないので間引く
+        ax = overlay.decimate(int(figsize[0] * dpi)).plot(legend=False,
+                                                          color=color,
+                                                          linewidth=linewidth,
+                                                          ylim=ylim,
+                                                          figsize=figsize,
+                                                          ax=ax1)
         # Marker plot
         if (self.markers is not None) and (len(self.markers) > 0):
             maxs = self.reindex(self.markers).loc[self.markers].max(1)
@@ -293,21 +360,17 @@ class Trace(pd.DataFrame):
         ax.xaxis.set_ticks_position('top')  # xラベル上にする
         ax.yaxis.set_ticks_position('left')
 
-        # __MAKE WATERFALL DATA________________
-        dfk = self.T.resample(FREQ).first()  # 隙間埋める
-        dfk = dfk.reindex(pd.date_range(title, freq=FREQ,
-                                        periods=PERIODS))  # 最初/最後埋め
-        dfk.index = np.arange(len(dfk))  # 縦軸はdatetime index描画できないのでintにする
-
         # __PLOT WATERFALL______________
-        ax2 = plt.subplot(G[1:, :-1], sharex=ax1, rasterized=True)
+        plt.subplot(G[1:, :-1], sharex=ax1, rasterized=True)
         # 容量軽減のためここだけラスターイメージで描く
         interval = np.linspace(cmaplow, cmaphigh, cmaplevel)  # cmapの段階
-        x, y, z = dfk.columns.values, dfk.index.values, dfk.values
+        # 縦軸は時刻(hour)
+        x = self.index.values
+        y = np.arange(len(grid)) * factor * rate / 3600
         # Waterfall plot
         ax = plt.contourf(x,
                           y,
-                          z,
+                          grid,
                           interval,
                           alpha=.75,
                           cmap=cmap,
@@ -317,11 +380,8 @@ class Trace(pd.DataFrame):
         ax.cmap.set_under("white")
         ax.changed()
 
-        d5 = pd.date_range('00:00', '23:55',
-                           freq=FREQ).strftime('%H:%M')  # 5分ごとの文字列
-        d5 = np.append(d5, '24:00')  # 24:00は作れないのでappend
-        # ...しようとしたけど、上のグラフとラベルかぶるから廃止
-        yticks(np.arange(0, PERIODS + 1, 24), d5[::24])
+        hours = np.arange(0, 25, 2)  # 2時間ごと
+        yticks(hours, [f'{h:02d}:00' for h in hours])
         plt.xlabel(xlabel)
         plt.ylabel(title)
 
@@ -358,16 +418,114 @@ class Trace(pd.DataFrame):
         return nan_idx
 
 
+def trace_stem(filename) -> str:
+    """TRACE_SUFFIXESの拡張子を除いたファイル名
+
+    >>> trace_stem('data/20161108_020104.txt.gz')
+    '20161108_020104'
+    """
+    name = Path(filename).name
+    for suffix in sorted(TRACE_SUFFIXES, key=len, reverse=True):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return Path(filename).stem
+
+
+def open_trace(filename):
+    """テキストモードで開いたファイルを返す
+    .gz, .zstは展開しながら読む
+    """
+    if str(filename).endswith('.gz'):
+        return gzip.open(filename, 'rt')
+    if str(filename).endswith('.zst'):
+        import zstandard  # optional dependency
+        return zstandard.open(filename, 'rt')
+    return open(filename, 'r')
+
+
+@contextlib.contextmanager
+def _open_data(data):
+    """ファイル名ならopen_trace()で開き、
+    ファイルオブジェクト(io.StringIOなど)なら先頭に戻してそのまま返す
+    """
+    if hasattr(data, 'read'):
+        data.seek(0)
+        yield data
+    else:
+        with open_trace(data) as f:
+            yield f
+
+
+def find_traces(pattern: str) -> dict[str, str]:
+    """globパターン(拡張子なし)に一致するテキストファイルを
+    {拡張子なしのファイル名: パス}で返す
+    同じファイル名が複数あるとき(圧縮中)は非圧縮のファイルを優先する
+    """
+    found = {}
+    for suffix in reversed(TRACE_SUFFIXES):
+        for f in glob.iglob(f'{pattern}{suffix}'):
+            found[trace_stem(f)] = f
+    return found
+
+
+def freq_index(config: dict) -> pd.Index:
+    """configの:FREQ:CENT, :FREQ:SPAN, :SWE:POINから周波数のindexを作る"""
+    center, _ = config_parse_freq(config[':FREQ:CENT'])
+    span, unit = config_parse_freq(config[':FREQ:SPAN'])
+    # VISAコマンドのデフォルト値は1001ポイント
+    points = int(config[':SWE:POIN']) if ":SWE:POIN" in config.keys() else 1001
+    return pd.Index(np.linspace(
+        center - span / 2,
+        center + span / 2,
+        points,
+    ),
+                    name=unit)
+
+
+def trace_freq_index(data) -> pd.Index:
+    """data(ファイル名またはファイルオブジェクト)の1行目のconfigから周波数のindexを作る"""
+    with _open_data(data) as f:
+        return freq_index(read_conf(f.readline()))
+
+
+def _read_block(
+    filename,
+    names: list[str],
+    usecols,
+    start: int,
+    stop: int,
+) -> pd.DataFrame:
+    """filename(またはファイルオブジェクト)のデータ行start:stopのusecols列だけを読み込む
+    範囲外の行は数値に変換せずに読み飛ばす。
+    ファイルの最後まで読んだときは最終行をフッタとして捨てる。
+    """
+    cols = [usecols] if isinstance(usecols, str) else list(usecols or names)
+    with _open_data(filename) as f:
+        lines = list(itertools.islice(f, start + 1, stop + 1))  # 1行目はconfig
+        if len(lines) < stop - start or not f.readline():
+            lines = lines[:-1]  # 最終行はフッタ
+    df = pd.read_csv(io.StringIO(''.join(lines)),
+                     sep=r'\s+',
+                     header=None,
+                     usecols=[0] + [names.index(c) + 1 for c in cols],
+                     index_col=0)
+    df.columns = cols
+    return df
+
+
 def read_trace(
     data: str,
     config: dict = None,
     usecols: Optional[str] = None,  # overwrited arg
     *args,
+    freq_range: Optional[tuple[float, float]] = None,
     **kwargs,
 ) -> Trace:
     """dataを読み取ってグラフ用データを返す
-    dataはファイル名またはdata string
-    > 後者の場合はbase64.b64decode(byte).decode()などとして使用する。
+    dataはファイル名またはファイルオブジェクト
+    > data stringはio.StringIO(base64.b64decode(byte).decode())
+    > などとして使用する(read_trace_text())。
+    ファイル名の拡張子が.gz, .zstのときは展開しながら読む。
 
     1行目にスペクトラムアナライザの設定が入っているので、
     dictionaryで返し、
@@ -376,20 +534,43 @@ def read_trace(
 
     usecolsオプションはconfigの:TRACE:TYPEパース後の名称を指定する。
     (ex: AVER, MAXH, MINH)
+
+    freq_rangeに(最小周波数, 最大周波数)を指定すると、
+    ヘッダから該当する行の範囲を求めてその行だけを読み込む。
+    usecolsかfreq_rangeを指定したときは必要な列と行以外は数値に変換しない。
     """
     if config is None:  # configを指定しなければ
         # 自動でdataの1行目をconfigとして読み込む
-        with open(data, 'r') as f:
+        with _open_data(data) as f:
             config = read_conf(f.readline())
 
     # Set config
     names = [v for k, v in config.items() if k.startswith(':TRAC')]
-    center, _ = config_parse_freq(config[':FREQ:CENT'])
-    span, unit = config_parse_freq(config[':FREQ:SPAN'])
-    # VISAコマンドのデフォルト値は1001ポイント
-    points = int(config[':SWE:POIN']) if ":SWE:POIN" in config.keys() else 1001
+    index = freq_index(config)
+    points = len(index)
+
+    # 周波数範囲と列を絞って読み込む
+    # ファイルオブジェクトも同じように行ごとに読み込む
+    filelike = hasattr(data, 'read')
+    pushdown = usecols is not None or freq_range is not None or filelike
+    readable = filelike or isinstance(data, (str, Path))
+    if pushdown and readable and not args and not kwargs:
+        start, stop = 0, points
+        if freq_range is not None:
+            start = int(np.searchsorted(index, freq_range[0]))
+            stop = int(np.searchsorted(index, freq_range[1], side='right'))
+        df = _read_block(data, names, usecols, start, stop)
+        # 1列目の値によらず行の位置で周波数を割り当てる
+        df.index = index[start:start + len(df)]
+        if len(df) < stop - start:  # 書き込み途中のファイルはNaNで埋める
+            df = df.reindex(index=index[start:stop])
+        if isinstance(usecols, str):
+            df = df[usecols]
+        return Trace(df)
 
     # Read DataFrame from filename or string
+    if filelike:
+        data.seek(0)
     df = pd.read_csv(data,
                      sep=r'\s+',
                      index_col=0,
@@ -409,30 +590,302 @@ def read_trace(
         df = df.reindex(index=range(points), columns=names)
 
     # indexをconfigに合わせて変更
-    df.index = np.linspace(
-        center - span / 2,
-        center + span / 2,
-        points,
-    )
-    df.index.name = unit
+    df.index = index
     if usecols is not None:
         df = df[usecols]  # Select cols
     return Trace(df)
 
 
-def read_traces(*files, usecols: str, **kwargs):
+def read_trace_text(text: str,
+                    usecols=None,
+                    freq_range: Optional[tuple[float, float]] = None) -> Trace:
+    """txtファイルの中身(文字列)をread_trace()と同じように読み込む"""
+    return read_trace(io.StringIO(text), usecols=usecols, freq_range=freq_range)
+
+
+def is_complete(filename) -> bool:
+    """ファイルが書き込み途中でなければTrue
+    1行目のヘッダ、:SWE:POIN行のデータ、最終行のフッタが揃っているかを調べる。
+    filenameにはファイルオブジェクトも指定できる。
+    """
+    try:
+        with _open_data(filename) as f:
+            config = read_conf(f.readline())
+            nlines = 1 + sum(1 for _ in f)
+    except (OSError, EOFError, UnicodeDecodeError, IndexError):
+        return False
+    # VISAコマンドのデフォルト値は1001ポイント
+    points = int(config[':SWE:POIN']) if ":SWE:POIN" in config.keys() else 1001
+    return nlines >= points + 2  # ヘッダ + データ + フッタ
+
+
+def read_traces(*files, usecols, max_workers: int = 8, **kwargs):
     """複数ファイルにread_trace()して1つのTraceにまとめる
 
     usecolsを指定しないとValueError
-    ['AVER'], ['MINH'], ['MAXH']などを指定する。
+    'AVER', 'MINH', 'MAXH'などを指定する。
+    ['AVER', 'MAXH']のようにリストで指定すると、各ファイルを一度だけ読み込んで
+    {列名: Trace}の辞書を返す。
+
+    ネットワークドライブ上のファイルでも待ち時間が重ならないように
+    max_workers個のスレッドで並行して読み込む。
+    列はファイル名のタイムスタンプ順に並べる。
+    読み込めなかったファイルは飛ばして、
+    {ファイル名: エラー}を戻り値の`attrs['errors']`に入れる。
+
+    最初に読めたファイルのヘッダから 周波数 x ファイル数 の配列を列名ごとに一度だけ確保し、
+    読み込んだファイルから順に列を埋めるので、
+    ピークメモリは戻り値の大きさ程度で済む。
+    周波数の点数が最初のファイルと異なるファイルはエラーとする。
     """
-    return Trace({
-        datetime.datetime.strptime(Path(f).stem, '%Y%m%d_%H%M%S'):  # basename
-        read_trace(f, usecols=usecols, *kwargs).squeeze()
-        for f in tqdm(files, leave=False)  # remove progress bar after all
+    cols = [usecols] if isinstance(usecols, str) else list(usecols)
+    stamps = {
+        f: datetime.datetime.strptime(trace_stem(f), '%Y%m%d_%H%M%S')
+        for f in files  # basename
+    }
+    files = sorted(files, key=stamps.get)
+    errors = {}
+
+    def _result(traces: dict):
+        for trss in traces.values():
+            trss.attrs['errors'] = {f: errors[f] for f in files if f in errors}
+        return traces[usecols] if isinstance(usecols, str) else traces
+
+    # 最初に読めたヘッダから周波数軸を決めて配列を確保
+    index = None
+    for f in files:
+        try:
+            with open_trace(f) as _f:
+                index = freq_index(read_conf(_f.readline()))
+            break
+        except Exception as _e:
+            errors[f] = _e
+    if index is None:
+        return _result({col: Trace() for col in cols})
+    freq_range = kwargs.get('freq_range')
+    if freq_range is not None:  # read_trace()と同じ範囲に絞る
+        index = index[np.searchsorted(index, freq_range[0]):np.
+                      searchsorted(index, freq_range[1], side='right')]
+    # 列ごとに連続したメモリになるようにFortran order
+    values = {
+        col: np.full((len(index), len(files)), np.nan, order='F')
+        for col in cols
+    }
+    ok = np.zeros(len(files), dtype=bool)
+
+    def _read(i):
+        try:
+            df = read_trace(files[i], usecols=cols, **kwargs)
+            if len(df) != len(index):
+                raise ValueError(f'周波数の点数が異なります {len(df)} != {len(index)}')
+            for col in cols:
+                values[col][:, i] = df[col].to_numpy(dtype=float)
+            ok[i] = True
+        except Exception as _e:
+            errors[files[i]] = _e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in tqdm(executor.map(_read, range(len(files))),
+                      total=len(files),
+                      leave=False):  # remove progress bar after all
+            pass
+
+    columns = pd.DatetimeIndex([stamps[f] for f in files])
+    if not ok.all():  # 読めなかった列を除く(このときだけコピーが発生する)
+        values = {col: v[:, ok] for col, v in values.items()}
+        columns = columns[ok]
+    return _result({
+        col: Trace(pd.DataFrame(v, index=index, columns=columns, copy=False))
+        for col, v in values.items()
     })
 
 
+def has_arrow() -> bool:
+    """pyarrowがインストールされていればTrue"""
+    try:
+        import pyarrow  # noqa: F401 optional dependency
+    except ImportError:
+        return False
+    return True
+
+
+def _arrow_schema(trs: Trace):
+    """Arrowファイルのスキーマ
+    1レコードバッチ=1スイープで、各列は周波数点数長の固定長リスト。
+    周波数軸はスキーマのメタデータに持つ。
+    """
+    import pyarrow as pa  # optional dependency
+    points = len(trs.index)
+    fields = [pa.field('time', pa.timestamp('s'))]
+    fields += [
+        pa.field(str(col), pa.list_(pa.float32(), points))
+        for col in trs.columns
+    ]
+    metadata = {
+        'start': repr(float(trs.index[0])),
+        'stop': repr(float(trs.index[-1])),
+        'points': str(points),
+        'unit': str(trs.index.name),
+    }
+    return pa.schema(fields, metadata=metadata)
+
+
+def append_arrow(filename, trs: Trace, timestamp: datetime.datetime):
+    """1スイープ分のTrace(read_trace()の戻り値)を
+    Arrow IPCストリーム形式のファイルに1レコードバッチとして追記する。
+
+    ファイルが存在しなければスキーマを書き込んでから追記する。
+    周波数軸や列が既存のファイルと異なるときはValueError。
+    レコードバッチはzstdで圧縮する。
+    書き込みに失敗したときは追記前の長さに切り詰めてから例外を送出する。
+    """
+    import pyarrow as pa  # optional dependency
+    schema = _arrow_schema(trs)
+    batch = pa.record_batch(
+        [pa.array([timestamp], pa.timestamp('s'))] + [
+            pa.FixedSizeListArray.from_arrays(
+                pa.array(trs[col].to_numpy(dtype=np.float32)), len(trs))
+            for col in trs.columns
+        ],
+        schema=schema,
+    )
+    options = pa.ipc.IpcWriteOptions(compression='zstd')
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema, options=options) as writer:
+        writer.write_batch(batch)
+    # ストリームはスキーマ, バッチ, 終端のメッセージの連続なので
+    # 新規ファイルにはスキーマとバッチ、追記時はバッチだけを書き込む
+    messages = pa.ipc.MessageReader.open_stream(sink.getvalue())
+    schema_message = messages.read_next_message()
+    batch_message = messages.read_next_message()
+    path = Path(filename)
+    if path.exists() and path.stat().st_size > 0:
+        with pa.ipc.open_stream(str(path)) as reader:
+            if not reader.schema.equals(schema, check_metadata=True):
+                raise ValueError(f'{path} と周波数軸または列が異なります')
+        body = batch_message.serialize()
+    else:
+        body = schema_message.serialize().to_pybytes() + \
+            batch_message.serialize().to_pybytes()
+    with open(path, 'ab') as f:
+        size = f.tell()
+        try:
+            f.write(body)
+            f.flush()
+        except BaseException:
+            f.truncate(size)  # 途中まで書いたメッセージを残さない
+            raise
+
+
+def repair_arrow(filename) -> int:
+    """途中で切れたArrowファイルを最後の完全なメッセージまで切り詰め、
+    捨てたバイト数を返す(append_arrow()の書き込み中に落ちたとき)
+    スキーマも読めないときはValueError
+    """
+    import pyarrow as pa  # optional dependency
+    path = Path(filename)
+    size = path.stat().st_size
+    good = 0
+    with pa.OSFile(str(path)) as f:
+        while True:
+            try:
+                pa.ipc.read_message(f)
+            except (pa.ArrowInvalid, OSError, EOFError):
+                break
+            good = f.tell()
+    if good == 0:
+        raise ValueError(f'{path} はArrowファイルとして読めません')
+    if good < size:
+        os.truncate(path, good)
+    return size - good
+
+
+def arrow_timestamps(filename) -> list[datetime.datetime]:
+    """Arrowファイルに書き込まれているスイープの時刻のリスト"""
+    import pyarrow as pa  # optional dependency
+    with pa.ipc.open_stream(str(filename)) as reader:
+        return [t for batch in reader for t in batch['time'].to_pylist()]
+
+
+def read_arrow(
+    filename,
+    usecols: str,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    freq_range: Optional[tuple[float, float]] = None,
+) -> Trace:
+    """append_arrow()で書き出したファイルから
+    read_traces()と同じ形のTrace(index: 周波数, columns: datetime)を返す。
+
+    start, endで時刻の範囲(両端含む)、freq_rangeで周波数の範囲(両端含む)を指定する。
+    範囲外のスイープは展開せずに読み飛ばす。
+    """
+    import pyarrow as pa  # optional dependency
+    with pa.ipc.open_stream(str(filename)) as reader:
+        meta = reader.schema.metadata
+        points = int(meta[b'points'])
+        freqs = np.linspace(float(meta[b'start']), float(meta[b'stop']),
+                            points)
+        lo, hi = 0, points
+        if freq_range is not None:
+            lo, hi = np.searchsorted(freqs, freq_range[0]), np.searchsorted(
+                freqs, freq_range[1], side='right')
+        times, rows = [], []
+        for batch in reader:
+            _times = batch['time'].to_numpy(zero_copy_only=False)
+            mask = np.ones(len(_times), dtype=bool)
+            if start is not None:
+                mask &= _times >= np.datetime64(start)
+            if end is not None:
+                mask &= _times <= np.datetime64(end)
+            if not mask.any():
+                continue
+            values = batch[usecols].values.to_numpy().reshape(-1, points)
+            times.extend(_times[mask])
+            rows.append(values[mask, lo:hi])
+    index = pd.Index(freqs[lo:hi], name=meta[b'unit'].decode())
+    data = np.vstack(rows).T if rows else np.empty((hi - lo, 0))
+    return Trace(data.astype(float),
+                 index=index,
+                 columns=pd.DatetimeIndex(times))
+
+
+def day_grid(trss: pd.DataFrame, day: str, rate: int) -> np.ndarray:
+    """Trace(index: 周波数, columns: datetime)を
+    1日をrate秒ごとに区切った 時刻 x 周波数 の配列にする。
+    データのない時刻はNaN
+    """
+    rows = DAY_SECOND // rate
+    grid = np.full((rows, len(trss.index)), np.nan, dtype=np.float32)
+    seconds = (pd.DatetimeIndex(trss.columns) -
+               pd.Timestamp(day)).total_seconds().to_numpy()
+    slots = (seconds // rate).astype(int)
+    ok = (slots >= 0) & (slots < rows)
+    grid[slots[ok]] = trss.to_numpy(dtype=np.float32).T[ok]
+    return grid
+
+
+def reduce_rows(grid: np.ndarray, factor: int, how: str = 'max') -> np.ndarray:
+    """factor行ごとに最大値('max')か平均値('mean')に縮約する(NaNは無視)
+
+    >>> reduce_rows(np.arange(6.0).reshape(3, 2), 2)
+    array([[2., 3.],
+           [4., 5.]])
+    """
+    if factor == 1:
+        return grid
+    rows = -(-len(grid) // factor)
+    padded = np.full((rows * factor, grid.shape[1]), np.nan, dtype=grid.dtype)
+    padded[:len(grid)] = grid
+    blocks = padded.reshape(rows, factor, -1)
+    if how == 'mean':
+        count = np.sum(~np.isnan(blocks), axis=1)
+        total = np.nansum(blocks, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(count > 0, total / count, np.nan)
+    return np.fmax.reduce(blocks, axis=1)
+
+
 def db2mw(a):
     """dB -> mW
     Usage: `df.db2mw()` or `db2mw(df)`